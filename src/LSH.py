@@ -4,8 +4,13 @@
 # each groups contains all documents which share a given hash
 # given a query document, we are albe to retrieve all similar documents efficiently
 
+import concurrent.futures
 import hashlib
 import os
+import struct
+import time
+
+import numpy
 
 def smallHash(number, text):
     """
@@ -32,6 +37,82 @@ def computeShingles(q, document):
         shingles.append(shingle)
     return shingles
 
+def shingleHash(shingle):
+    """
+    Hash a single `shingle` into a 64-bit unsigned integer.
+    Unlike `smallHash`, this is only called once per shingle,
+    the family of hash functions is applied on top of it by `MinHasher`.
+    """
+    m = hashlib.blake2b(shingle.encode('utf-8'), digest_size=8)
+    return int.from_bytes(m.digest(), 'little')
+
+class MinHasher:
+    """
+    A vectorised MinHash signature engine.
+    Every shingle is hashed once into a 64-bit integer x, and the `nbHashes`
+    permutations are multiply-shift universal hashes
+        h_i(x) = ((a_i * x + b_i) mod 2^64) >> 32
+    with the coefficients a_i (odd) and b_i drawn from `seed`.
+    The signatures of a batch of documents are computed in one NumPy pass.
+    """
+
+    # upper limit on the size of the (nbHashes x shingles) matrix of a batch
+    maxCells = 1 << 22
+
+    def __init__(self, q, nbHashes, seed=0):
+        self.q = q
+        self.nbHashes = nbHashes
+        self.seed = seed
+        rng = numpy.random.default_rng(seed)
+        self.a = numpy.frombuffer(rng.bytes(8 * nbHashes), dtype=numpy.uint64) | numpy.uint64(1)
+        self.b = numpy.frombuffer(rng.bytes(8 * nbHashes), dtype=numpy.uint64)
+
+    def shingleHashes(self, document):
+        return numpy.fromiter( ( shingleHash(shingle)
+                                 for shingle in computeShingles(self.q, document) )
+                             , dtype=numpy.uint64 )
+
+    def signatures(self, documents):
+        """
+        Compute the MinHash signatures of a list of `documents`.
+
+        Returns
+            signatures : numpy.ndarray (len(documents), nbHashes) of uint64
+            valid      : numpy.ndarray (len(documents),) of bool
+                         -- False for documents too short to have any shingles
+        """
+        allHashes = [ self.shingleHashes(document) for document in documents ]
+        sigs = numpy.zeros((len(documents), self.nbHashes), dtype=numpy.uint64)
+        valid = numpy.array([ len(h) > 0 for h in allHashes ], dtype=bool)
+        shift = numpy.uint64(32)
+        start = 0
+        while start < len(documents):
+            # grow the batch until it would exceed maxCells
+            end = start
+            cells = 0
+            while end < len(documents) and (end == start or cells + len(allHashes[end]) * self.nbHashes <= self.maxCells):
+                cells += len(allHashes[end]) * self.nbHashes
+                end += 1
+            batch = [ i for i in range(start, end) if valid[i] ]
+            if batch:
+                lengths = [ len(allHashes[i]) for i in batch ]
+                offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+                x = numpy.concatenate([ allHashes[i] for i in batch ])
+                permuted = (self.a[:, None] * x[None, :] + self.b[:, None]) >> shift
+                sigs[batch] = numpy.minimum.reduceat(permuted, offsets, axis=1).T
+            start = end
+        return sigs, valid
+
+    def computeHashes(self, document):
+        """
+        Drop-in replacement for `computeHashes`: a list of nbHashes minhashes, or None.
+        """
+        sigs, valid = self.signatures([document])
+        if valid[0]:
+            return [ int(h) for h in sigs[0] ]
+        else:
+            return None
+
 def computeHashes(q, hashIDs, document):
     hashes = []
     shingles = computeShingles(q, document)
@@ -44,9 +125,53 @@ def computeHashes(q, hashIDs, document):
     else:
         return None
 
-def computeSignature(q, nbBands, bandSize, document):
+class Md5Hasher:
+    """
+    The md5 based `computeHashes`, behind the same interface as `MinHasher`.
+    """
+
+    def __init__(self, q, nbHashes):
+        self.q = q
+        self.nbHashes = nbHashes
+
+    def signatures(self, documents):
+        sigs = numpy.zeros((len(documents), self.nbHashes), dtype=numpy.uint64)
+        valid = numpy.zeros(len(documents), dtype=bool)
+        for (i, document) in enumerate(documents):
+            hashes = computeHashes(self.q, range(self.nbHashes), document)
+            if hashes:
+                sigs[i] = hashes
+                valid[i] = True
+        return sigs, valid
+
+    def computeHashes(self, document):
+        return computeHashes(self.q, range(self.nbHashes), document)
+
+def computeBandKeys(signatures, bandSize):
+    """
+    Vectorised counterpart of `smallHash(bandID, str(band))`.
+    Chop each row of `signatures` into bands of `bandSize` and fold every band,
+    tagged with its band number, into a single 64-bit bucket key (FNV-1a over 64-bit words).
+
+    Returns
+        keys : numpy.ndarray (len(signatures), nbBands) of uint64
+    """
+    nbBands = signatures.shape[1] // bandSize
+    bands = signatures.reshape(len(signatures), nbBands, bandSize)
+    prime = numpy.uint64(0x100000001b3)
+    keys = numpy.uint64(0xcbf29ce484222325) ^ numpy.arange(nbBands, dtype=numpy.uint64)
+    keys = numpy.repeat(keys[None, :] * prime, len(signatures), axis=0)
+    for k in range(bandSize):
+        keys = (keys ^ bands[:, :, k]) * prime
+    return keys ^ (keys >> numpy.uint64(29))
+
+def computeSignature(q, nbBands, bandSize, document, engine=None):
     # calculate the vector of hashes
-    hashes = computeHashes(q, range(nbBands * bandSize), document)
+    # `engine` is an optional MinHasher(q, nbBands * bandSize), used instead of md5
+    if engine is None:
+        hashes = computeHashes(q, range(nbBands * bandSize), document)
+    else:
+        hashes = engine.computeHashes(document)
 
     if hashes:
         # chop them up
@@ -58,8 +183,8 @@ def computeSignature(q, nbBands, bandSize, document):
     else:
         return None
 
-def addToStore(q, nbBands, bandSize, documentStore, document):
-    signature = computeSignature(q, nbBands, bandSize, document)
+def addToStore(q, nbBands, bandSize, documentStore, document, engine=None):
+    signature = computeSignature(q, nbBands, bandSize, document, engine)
     if signature:
         for (bandID, band) in signature:
             sig = smallHash(bandID, str(band))
@@ -67,8 +192,8 @@ def addToStore(q, nbBands, bandSize, documentStore, document):
                 documentStore[sig] = set()
             documentStore[sig].add(tuple(document))
 
-def lookup(q, nbBands, bandSize, documentStore, document):
-    signature = computeSignature(q, nbBands, bandSize, document)
+def lookup(q, nbBands, bandSize, documentStore, document, engine=None):
+    signature = computeSignature(q, nbBands, bandSize, document, engine)
     results = set()
     for (bandID, band) in signature:
         sig = smallHash(bandID, str(band))
@@ -78,6 +203,441 @@ def lookup(q, nbBands, bandSize, documentStore, document):
     return results
 
 
+def triuBlocks(size, blockSize):
+    """
+    The pairs (k, l), k < l, of positions in a bucket of `size` records, as (left, right) arrays,
+    in row order, about `blockSize` pairs (and at least one row) at a time,
+    without ever building all the size * (size - 1) / 2 pairs of a large bucket.
+    """
+    if size * (size - 1) // 2 <= blockSize:
+        yield numpy.triu_indices(size, 1)
+        return
+    # the number of pairs before every row
+    rowStarts = numpy.concatenate(([ 0 ], numpy.cumsum(numpy.arange(size - 1, 0, -1))))
+    row = 0
+    while row < size - 1:
+        end = max(row + 1, int(numpy.searchsorted(rowStarts, rowStarts[row] + blockSize, side='right')) - 1)
+        end = min(end, size - 1)
+        rows = numpy.arange(row, end)
+        counts = size - 1 - rows
+        left = numpy.repeat(rows, counts)
+        right = numpy.arange(len(left)) - numpy.repeat(numpy.cumsum(counts) - counts, counts) + left + 1
+        yield (left, right)
+        row = end
+
+def bucketPairs(ids, offsets, usable, blockSize=1<<16):
+    """
+    Expand CSR buckets (the members of bucket b being ids[offsets[b]:offsets[b+1]]) into pairs.
+    Every pair of members of every `usable` bucket is yielded once, the members in bucket order.
+    Buckets of equal size are expanded together, and large buckets a range of rows at a time,
+    so a block never holds many more than `blockSize` pairs.
+
+    Yields
+        i, j    : numpy.ndarray of record IDs
+        buckets : numpy.ndarray, the bucket of every pair
+    """
+    sizes = numpy.diff(offsets)
+    for size in numpy.unique(sizes[usable & (sizes >= 2)]):
+        buckets = numpy.flatnonzero(usable & (sizes == size))
+        if size * (size - 1) // 2 <= blockSize:
+            (left, right) = numpy.triu_indices(size, 1)
+            perChunk = max(1, blockSize // len(left))
+            for start in range(0, len(buckets), perChunk):
+                chunk = buckets[start : start+perChunk]
+                members = ids[offsets[chunk][:, None] + numpy.arange(size)]
+                yield (members[:, left].ravel(), members[:, right].ravel(), numpy.repeat(chunk, len(left)))
+        else:
+            for bucket in buckets:
+                members = ids[offsets[bucket] : offsets[bucket+1]]
+                for (left, right) in triuBlocks(size, blockSize):
+                    yield (members[left], members[right], numpy.full(len(left), bucket))
+
+
+class LSHIndex:
+    """
+    An LSH document store that works on record IDs instead of record tuples.
+
+    Records are kept once, in a columnar table (one list per field; a string
+    document is a record with a single field), and are identified by their
+    insertion order. Buckets only hold int32 record IDs.
+    The bucket keys of every inserted record are kept (`recordKeys`), so that
+    records already in the index can be looked up by ID without recomputing
+    their signatures; `freeze` lays them out as CSR posting lists:
+        bucketKeys : sorted uint64 bucket keys
+        offsets    : postings of bucketKeys[k] are ids[offsets[k]:offsets[k+1]]
+        ids        : int32 record IDs, ascending within each bucket
+    so memory grows with the number of bucket entries, not the record width.
+    """
+
+    def __init__(self, q, nbBands, bandSize, engine=None, seed=0, blockingStats=None):
+        self.q = q
+        self.nbBands = nbBands
+        self.bandSize = bandSize
+        if engine is None:
+            engine = MinHasher(q, nbBands * bandSize, seed)
+        self.seed = getattr(engine, 'seed', seed)
+        self.engine = engine
+        # an optional evaluation.BlockingStats, its records and blocks updated as records are inserted;
+        # the overall pair figures need a pass over candidatePairs, fed to BlockingStats.addPairs by the caller
+        self.blockingStats = blockingStats
+        self.columns = None
+        self.textRecords = False
+        # the ID of the first record in `columns`: an index read by `load` has no records,
+        # so only the records added after loading are kept
+        self.firstStoredID = 0
+        self.nbRecords = 0
+        self.recordKeys = numpy.zeros((0, nbBands), dtype=numpy.uint64)
+        self.hasSignature = numpy.zeros(0, dtype=bool)
+        self._pendingKeys = []
+        self._pendingValid = []
+        self.bucketKeys = numpy.zeros(0, dtype=numpy.uint64)
+        self.offsets = numpy.zeros(1, dtype=numpy.int64)
+        self.ids = numpy.zeros(0, dtype=numpy.int32)
+        self.bucketBands = numpy.zeros(0, dtype=numpy.int16)
+        self.frozen = True
+        self.skippedBuckets = 0
+        self.skippedPairs = 0
+
+    def __len__(self):
+        return self.nbRecords
+
+    def _storeRecords(self, documents):
+        for document in documents:
+            if self.columns is None:
+                self.firstStoredID = self.nbRecords
+                self.textRecords = isinstance(document, str)
+                width = 1 if self.textRecords else len(document)
+                self.columns = [ [] for _ in range(width) ]
+            fields = [document] if self.textRecords else document
+            if len(fields) != len(self.columns):
+                raise ValueError("Mismatch in the number of fields, %d vs %d" % (len(self.columns), len(fields)))
+            for (column, value) in zip(self.columns, fields):
+                column.append(value)
+
+    def record(self, recordID):
+        if recordID < self.firstStoredID or recordID >= self.nbRecords:
+            raise IndexError("Record %d is not stored in this index, it has records %d to %d"
+                             % (recordID, self.firstStoredID, self.nbRecords - 1))
+        fields = [ column[recordID - self.firstStoredID] for column in self.columns ]
+        return fields[0] if self.textRecords else fields
+
+    def bandKeys(self, documents):
+        """
+        Bucket keys of `documents`, and a mask of those that have a signature at all.
+        """
+        sigs, valid = self.engine.signatures(documents)
+        return computeBandKeys(sigs, self.bandSize), valid
+
+    def addMany(self, documents):
+        """
+        Insert a list of documents, returns their record IDs.
+        """
+        documents = list(documents)
+        recordIDs = numpy.arange(self.nbRecords, self.nbRecords + len(documents), dtype=numpy.int32)
+        keys, valid = self.bandKeys(documents)
+        self._storeRecords(documents)
+        self._pendingKeys.append(keys)
+        self._pendingValid.append(valid)
+        if self.blockingStats is not None:
+            self.blockingStats.addRecords(len(recordIDs))
+            self.blockingStats.add(keys[valid].ravel(), numpy.repeat(recordIDs[valid], self.nbBands))
+        self.nbRecords += len(documents)
+        self.frozen = False
+        return recordIDs
+
+    def add(self, document):
+        return int(self.addMany([document])[0])
+
+    def addStream(self, chunks, toDocument=None):
+        """
+        Insert the documents of a stream of chunks (for example common.iterCSV),
+        one chunk at a time. `toDocument` turns a streamed record into a document.
+        Returns the number of documents inserted.
+        """
+        nbRecords = self.nbRecords
+        for chunk in chunks:
+            if toDocument is not None:
+                chunk = [ toDocument(record) for record in chunk ]
+            self.addMany(chunk)
+        return self.nbRecords - nbRecords
+
+    def merge(self, other):
+        """
+        Append all records of another index (a shard) to this one.
+        The records of `other` get IDs following the ones already here;
+        their signatures are reused, not recomputed. Returns the new record IDs.
+        """
+        if (other.q, other.nbBands, other.bandSize) != (self.q, self.nbBands, self.bandSize) \
+           or type(other.engine) != type(self.engine) \
+           or getattr(other.engine, 'seed', None) != getattr(self.engine, 'seed', None):
+            raise ValueError("Cannot merge LSH indexes built with different parameters.")
+        recordIDs = numpy.arange(self.nbRecords, self.nbRecords + other.nbRecords, dtype=numpy.int32)
+        if other.nbRecords == 0:
+            return recordIDs
+        # the stored records must stay contiguous, up to the last one
+        if other.columns is not None:
+            if self.columns is None:
+                self.firstStoredID = self.nbRecords + other.firstStoredID
+                self.textRecords = other.textRecords
+                self.columns = [ [] for _ in other.columns ]
+            elif other.firstStoredID > 0:
+                raise ValueError("Cannot merge an index without some of its records into an index with records.")
+            if len(other.columns) != len(self.columns):
+                raise ValueError("Mismatch in the number of fields, %d vs %d" % (len(self.columns), len(other.columns)))
+            for (column, otherColumn) in zip(self.columns, other.columns):
+                column.extend(otherColumn)
+        elif self.columns is not None:
+            raise ValueError("Cannot merge an index without its records into an index with records.")
+        otherKeys = numpy.concatenate([other.recordKeys] + other._pendingKeys)
+        otherValid = numpy.concatenate([other.hasSignature] + other._pendingValid)
+        self._pendingKeys.append(otherKeys)
+        self._pendingValid.append(otherValid)
+        if self.blockingStats is not None:
+            self.blockingStats.addRecords(len(recordIDs))
+            self.blockingStats.add(otherKeys[otherValid].ravel(), numpy.repeat(recordIDs[otherValid], self.nbBands))
+        self.nbRecords += other.nbRecords
+        self.frozen = False
+        return recordIDs
+
+    def freeze(self):
+        """
+        Sort the pending entries into the CSR posting lists.
+        """
+        if self.frozen:
+            return
+        self.recordKeys = numpy.concatenate([self.recordKeys] + self._pendingKeys)
+        self.hasSignature = numpy.concatenate([self.hasSignature] + self._pendingValid)
+        self._pendingKeys = []
+        self._pendingValid = []
+        recordIDs = numpy.flatnonzero(self.hasSignature).astype(numpy.int32)
+        keys = self.recordKeys[recordIDs].ravel()
+        ids = numpy.repeat(recordIDs, self.nbBands)
+        bands = numpy.tile(numpy.arange(self.nbBands, dtype=numpy.int16), len(recordIDs))
+        # stable, so that the IDs stay in insertion order within a bucket
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.ids = ids[order].astype(numpy.int32)
+        (self.bucketKeys, starts) = numpy.unique(keys, return_index=True)
+        self.bucketBands = bands[order][starts]
+        self.offsets = numpy.append(starts, len(keys)).astype(numpy.int64)
+        self.frozen = True
+
+    def postings(self, key):
+        """
+        Record IDs in the bucket with the given key (empty if there is no such bucket).
+        """
+        k = numpy.searchsorted(self.bucketKeys, key)
+        if k < len(self.bucketKeys) and self.bucketKeys[k] == key:
+            return self.ids[self.offsets[k] : self.offsets[k+1]]
+        else:
+            return self.ids[0:0]
+
+    def lookupKeys(self, keys):
+        self.freeze()
+        return numpy.unique(numpy.concatenate([ self.postings(key) for key in keys ]))
+
+    def lookup(self, document):
+        """
+        IDs of all records sharing at least one bucket with `document`, as a sorted int32 array.
+        """
+        keys, valid = self.bandKeys([document])
+        if not valid[0]:
+            return self.ids[0:0]
+        return self.lookupKeys(keys[0])
+
+    def lookupById(self, recordID):
+        """
+        Same as `lookup(record(recordID))`, but reuses the stored bucket keys.
+        """
+        self.freeze()
+        if not self.hasSignature[recordID]:
+            return self.ids[0:0]
+        return self.lookupKeys(self.recordKeys[recordID])
+
+    def selfJoin(self):
+        """
+        Look up every record of the index against the index itself.
+        Yields (recordID, block) pairs, block being an array of record IDs.
+        """
+        self.freeze()
+        for recordID in range(self.nbRecords):
+            yield (recordID, self.lookupById(recordID))
+
+    def candidatePairs(self, maxBucketSize=None, blockSize=1<<16):
+        """
+        Stream the candidate pairs of a self-join of the index.
+
+        Every bucket is visited once, and every unordered pair (i, j), i < j,
+        sharing at least one bucket is emitted exactly once: from the first band
+        in which the two records share a bucket. Buckets with more than
+        `maxBucketSize` records are skipped, and counted in `skippedBuckets`
+        and `skippedPairs`.
+        Buckets are expanded by bucketPairs, so no per-record sets are built,
+        and a large bucket is never expanded in full.
+
+        Yields
+            pairs : numpy.ndarray (k, 2) of int32, about `blockSize` rows per block
+        """
+        self.freeze()
+        sizes = numpy.diff(self.offsets)
+        usable = numpy.ones(len(sizes), dtype=bool)
+        if maxBucketSize is not None:
+            usable = sizes <= maxBucketSize
+        skipped = sizes[~usable]
+        self.skippedBuckets = len(skipped)
+        self.skippedPairs = int((skipped * (skipped - 1) // 2).sum())
+        # the bucket of every (record, band), for records which have a signature
+        recordBuckets = numpy.searchsorted(self.bucketKeys, self.recordKeys)
+        recordBuckets[~self.hasSignature] = 0
+
+        pending = []
+        nbPending = 0
+        for (i, j, buckets) in bucketPairs(self.ids, self.offsets, usable, blockSize):
+            bands = self.bucketBands[buckets]
+            # keep a pair only in the first band where it shares a usable bucket
+            shared = (recordBuckets[i] == recordBuckets[j]) & usable[recordBuckets[i]]
+            keep = numpy.argmax(shared, axis=1) == bands
+            pending.append(numpy.stack((i[keep], j[keep]), axis=1))
+            nbPending += int(keep.sum())
+            if nbPending >= blockSize:
+                yield numpy.concatenate(pending)
+                pending = []
+                nbPending = 0
+        if nbPending > 0:
+            yield numpy.concatenate(pending)
+
+    def blockSizes(self):
+        self.freeze()
+        return numpy.diff(self.offsets)
+
+    # on-disk layout: a fixed size header, followed by the arrays in this order,
+    # each one starting at a multiple of 8 bytes
+    fileMagic = b"LSHINDEX"
+    fileVersion = 2
+    fileHeader = struct.Struct("<8sIIqqqqqqq32sI")
+    fileHeaderSize = 128
+
+    @staticmethod
+    def fileArrays(nbBands, nbRecords, nbBuckets, nbEntries):
+        return [ ("bucketKeys"  , numpy.uint64, (nbBuckets,))
+               , ("bucketBands" , numpy.int16 , (nbBuckets,))
+               , ("offsets"     , numpy.int64 , (nbBuckets + 1,))
+               , ("ids"         , numpy.int32 , (nbEntries,))
+               , ("recordKeys"  , numpy.uint64, (nbRecords, nbBands))
+               , ("hasSignature", numpy.bool_ , (nbRecords,))
+               ]
+
+    def save(self, path, dataDigest=b""):
+        """
+        Write the index to `path` in a flat binary format: a header with
+        q, nbBands, bandSize, the hash seed and `dataDigest` (an optional hash of the
+        input data, up to 32 bytes, and its length), then the sorted bucket keys, the offsets, the ids
+        and the stored band keys of every record. The records themselves are not saved.
+        """
+        self.freeze()
+        if isinstance(self.engine, MinHasher):
+            engineKind = 0
+        elif isinstance(self.engine, Md5Hasher):
+            engineKind = 1
+        else:
+            raise ValueError("Cannot save an LSH index using engine %s" % type(self.engine).__name__)
+        if len(dataDigest) > 32:
+            raise ValueError("The data digest is longer than 32 bytes")
+        header = self.fileHeader.pack( self.fileMagic, self.fileVersion, engineKind
+                                     , self.q, self.nbBands, self.bandSize, self.seed
+                                     , self.nbRecords, len(self.bucketKeys), len(self.ids)
+                                     , dataDigest, len(dataDigest) )
+        with open(path, "wb") as f:
+            f.write(header.ljust(self.fileHeaderSize, b"\0"))
+            for (name, dtype, shape) in self.fileArrays(self.nbBands, self.nbRecords, len(self.bucketKeys), len(self.ids)):
+                data = numpy.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes()
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Read an index written by `save`. With `mmap`, the arrays are read-only
+        numpy.memmap views of the file, so loading is immediate and the pages
+        are shared between all processes using the same file.
+        The loaded index has no record table: `record` raises IndexError for the loaded
+        records, look their IDs up in the original data instead. Records added afterwards
+        get the following IDs, and are stored as usual.
+        """
+        with open(path, "rb") as f:
+            header = f.read(cls.fileHeader.size)
+        (magic, version, engineKind, q, nbBands, bandSize, seed, nbRecords, nbBuckets, nbEntries, dataDigest, digestSize) = \
+            cls.fileHeader.unpack(header)
+        if magic != cls.fileMagic or version != cls.fileVersion:
+            raise ValueError("Not an LSH index file (version %d): %s" % (cls.fileVersion, path))
+        if engineKind == 0:
+            engine = MinHasher(q, nbBands * bandSize, seed)
+        else:
+            engine = Md5Hasher(q, nbBands * bandSize)
+        index = cls(q, nbBands, bandSize, engine, seed)
+        # the digest is stored with its length, as it may well end with zero bytes
+        index.dataDigest = dataDigest[:digestSize]
+        index.nbRecords = nbRecords
+        offset = cls.fileHeaderSize
+        for (name, dtype, shape) in cls.fileArrays(nbBands, nbRecords, nbBuckets, nbEntries):
+            nbBytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+            if nbBytes == 0:
+                array = numpy.zeros(shape, dtype=dtype)
+            elif mmap:
+                array = numpy.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+            else:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    array = numpy.fromfile(f, dtype=dtype, count=int(numpy.prod(shape))).reshape(shape)
+            setattr(index, name, array)
+            offset += nbBytes + (-nbBytes % 8)
+        index.frozen = True
+        return index
+
+
+def buildShard(q, nbBands, bandSize, engine, documents):
+    """
+    Build an unfrozen LSHIndex over `documents` in a worker process.
+    Returns the shard and (pid, number of records, CPU seconds).
+    """
+    start = time.process_time()
+    shard = LSHIndex(q, nbBands, bandSize, engine)
+    shard.addMany(documents)
+    return shard, (os.getpid(), len(documents), time.process_time() - start)
+
+def buildParallel(q, nbBands, bandSize, documents, nbWorkers=None, engine=None, seed=0, nbShards=None, blockingStats=None):
+    """
+    Build an LSHIndex over `documents` using a pool of `nbWorkers` processes.
+    The documents are split into `nbShards` contiguous shards (4 per worker by default),
+    each built by one worker, and the shards are merged in order,
+    so the result is identical to adding all documents to a single index.
+    The records and blocks of `blockingStats` are updated as the shards are merged.
+    """
+    import common
+
+    if nbWorkers is None:
+        nbWorkers = os.cpu_count()
+    if engine is None:
+        engine = MinHasher(q, nbBands * bandSize, seed)
+    if nbShards is None:
+        nbShards = 4 * nbWorkers
+    documents = list(documents)
+    shardSize = max(1, -(-len(documents) // nbShards))
+    shards = [ documents[x : x+shardSize]
+               for x in range(0, len(documents), shardSize) ]
+
+    index = LSHIndex(q, nbBands, bandSize, engine, seed, blockingStats)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nbWorkers) as executor:
+        futures = [ executor.submit(buildShard, q, nbBands, bandSize, engine, shard)
+                    for shard in shards ]
+        for (i, future) in enumerate(futures):
+            (shard, (pid, nbRecords, secs)) = future.result()
+            index.merge(shard)
+            common.tick("LSH shard %4d/%d, worker %6d: %8d records, %10.2f records/sec"
+                        % (i+1, len(shards), pid, nbRecords, nbRecords / secs if secs > 0 else float('inf')))
+    return index
+
+
 def main():
     documentStore = {}
     q = 5
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# an M-tree (Ciaccia, Patella, Zezula 1997) over records in a metric space
+# every node holds up to `nodeCapacity` entries, each entry covers a ball around a routing object
+# range and kNN queries skip subtrees using the distance to the parent routing object
+# and the covering radius, without calling the metric
+
+import heapq
+
+
+class MTreeEntry:
+    """
+    An entry of an M-tree node.
+    In a leaf it is a record, in an internal node it is a routing object,
+    covering every record of `child` within `radius`.
+    `parentDistance` is the distance to the routing object of the parent entry, None in the root.
+    """
+
+    def __init__(self, record, recordID, parentDistance, radius=0, child=None):
+        self.record = record
+        self.recordID = recordID
+        self.parentDistance = parentDistance
+        self.radius = radius
+        self.child = child
+
+
+class MTreeNode:
+
+    def __init__(self, isLeaf):
+        self.isLeaf = isLeaf
+        self.entries = []
+        self.parentEntry = None
+        self.parentNode = None
+
+
+class MTree:
+    """
+    An M-tree over records, using a pluggable `distance(a, b)` metric, for example
+        lambda a, b: common.calculateDistance(keyFields, common.levenshtein, common.sigmaMerge, a, b)
+    Every call to the metric is counted in `nbDistanceCalls`, whether it is made
+    while inserting or while querying.
+    The optional `distanceBatch(query, records)` computes the distances from `query` to a
+    list of records in one go (see common.calculateDistancesBatch), it is used to score leaves.
+    """
+
+    def __init__(self, distance, nodeCapacity=10, distanceBatch=None):
+        self.distance = distance
+        self.distanceBatch = distanceBatch
+        self.nodeCapacity = nodeCapacity
+        self.nbDistanceCalls = 0
+        self.nbRecords = 0
+        self.root = MTreeNode(isLeaf=True)
+
+    def __len__(self):
+        return self.nbRecords
+
+    def dist(self, a, b):
+        self.nbDistanceCalls += 1
+        return self.distance(a, b)
+
+    def distMany(self, query, records):
+        self.nbDistanceCalls += len(records)
+        if self.distanceBatch is None or len(records) == 0:
+            return [ self.distance(query, record) for record in records ]
+        else:
+            return self.distanceBatch(query, records)
+
+    def insert(self, record, recordID=None):
+        """
+        Insert `record`, identified by `recordID` (its insertion number by default).
+        """
+        if recordID is None:
+            recordID = self.nbRecords
+        node = self.root
+        parentDistance = None
+        while not node.isLeaf:
+            distances = [ self.dist(record, entry.record) for entry in node.entries ]
+            covering = [ k for (k, entry) in enumerate(node.entries) if distances[k] <= entry.radius ]
+            if covering:
+                # the closest routing object whose ball already covers the record
+                k = min(covering, key=lambda k: distances[k])
+            else:
+                # otherwise the one needing the smallest enlargement
+                k = min(range(len(distances)), key=lambda k: distances[k] - node.entries[k].radius)
+                node.entries[k].radius = distances[k]
+            parentDistance = distances[k]
+            node = node.entries[k].child
+        node.entries.append(MTreeEntry(record, recordID, parentDistance))
+        self.nbRecords += 1
+        if len(node.entries) > self.nodeCapacity:
+            self.split(node)
+        return recordID
+
+    def insertMany(self, records):
+        return [ self.insert(record) for record in records ]
+
+    def insertStream(self, chunks):
+        """
+        Insert the records of a stream of chunks (for example common.iterCSV).
+        Returns the number of records inserted.
+        """
+        nbRecords = self.nbRecords
+        for chunk in chunks:
+            self.insertMany(chunk)
+        return self.nbRecords - nbRecords
+
+    def split(self, node):
+        """
+        Split an overflowing node in two.
+        Promotion keeps the current routing object and promotes the entry farthest from it
+        (using the stored parent distances, so no extra metric calls), entries are
+        partitioned by the generalised hyperplane between the two.
+        """
+        entries = node.entries
+        if node.parentEntry is not None:
+            promoted1 = node.parentEntry
+            distances1 = [ entry.parentDistance for entry in entries ]
+        else:
+            promoted1 = entries[0]
+            distances1 = [ 0 ] + [ self.dist(entry.record, promoted1.record) for entry in entries[1:] ]
+        k2 = max(range(len(entries)), key=lambda k: distances1[k])
+        promoted2 = entries[k2]
+        distances2 = [ 0 if k == k2 else self.dist(entry.record, promoted2.record)
+                       for (k, entry) in enumerate(entries) ]
+
+        group1 = [ k for k in range(len(entries)) if k != k2 and distances1[k] <= distances2[k] ]
+        group2 = [ k for k in range(len(entries)) if k == k2 or distances1[k] > distances2[k] ]
+        if not group1:
+            k = min([ k for k in group2 if k != k2 ], key=lambda k: distances1[k])
+            group2.remove(k)
+            group1.append(k)
+
+        node2 = MTreeNode(node.isLeaf)
+        radii = []
+        for (target, group, distances) in [(node, group1, distances1), (node2, group2, distances2)]:
+            target.entries = [ entries[k] for k in group ]
+            for k in group:
+                entries[k].parentDistance = distances[k]
+                if entries[k].child is not None:
+                    entries[k].child.parentNode = target
+            radii.append(max(distances[k] + entries[k].radius for k in group))
+
+        if node.parentEntry is None:
+            # the root was split, grow the tree by one level
+            root = MTreeNode(isLeaf=False)
+            self.root = root
+            entry1 = MTreeEntry(promoted1.record, promoted1.recordID, None, radii[0], node)
+            entry2 = MTreeEntry(promoted2.record, promoted2.recordID, None, radii[1], node2)
+            for (entry, child) in [(entry1, node), (entry2, node2)]:
+                root.entries.append(entry)
+                child.parentEntry = entry
+                child.parentNode = root
+        else:
+            parentNode = node.parentNode
+            node.parentEntry.radius = radii[0]
+            if parentNode.parentEntry is None:
+                parentDistance = None
+            else:
+                parentDistance = self.dist(promoted2.record, parentNode.parentEntry.record)
+            entry2 = MTreeEntry(promoted2.record, promoted2.recordID, parentDistance, radii[1], node2)
+            node2.parentEntry = entry2
+            node2.parentNode = parentNode
+            parentNode.entries.append(entry2)
+            if len(parentNode.entries) > self.nodeCapacity:
+                self.split(parentNode)
+
+    def rangeQuery(self, query, radius):
+        """
+        All records within `radius` of `query`.
+        Returns a list of (recordID, distance) pairs.
+        """
+        results = []
+        stack = [(self.root, None)]
+        while stack:
+            (node, queryParentDistance) = stack.pop()
+            entries = [ entry for entry in node.entries
+                        if queryParentDistance is None
+                        or abs(queryParentDistance - entry.parentDistance) <= radius + entry.radius ]
+            distances = self.distMany(query, [ entry.record for entry in entries ])
+            for (entry, d) in zip(entries, distances):
+                if node.isLeaf:
+                    if d <= radius:
+                        results.append((entry.recordID, d))
+                elif d <= radius + entry.radius:
+                    stack.append((entry.child, d))
+        return results
+
+    def knnQuery(self, query, k):
+        """
+        The `k` records nearest to `query`.
+        Returns a list of (recordID, distance) pairs, nearest first.
+        """
+        nearest = []                    # a max-heap of (-distance, recordID)
+        pending = [(0, 0, self.root, None)]    # a min-heap of (lower bound, tie breaker, node, distance to its routing object)
+        counter = 1
+
+        def kthDistance():
+            return -nearest[0][0] if len(nearest) == k else float('inf')
+
+        while pending:
+            (bound, _, node, queryParentDistance) = heapq.heappop(pending)
+            if bound > kthDistance():
+                break
+            for entry in node.entries:
+                if queryParentDistance is not None and \
+                   abs(queryParentDistance - entry.parentDistance) - entry.radius > kthDistance():
+                    continue
+                d = self.dist(query, entry.record)
+                if node.isLeaf:
+                    if d < kthDistance():
+                        heapq.heappush(nearest, (-d, entry.recordID))
+                        if len(nearest) > k:
+                            heapq.heappop(nearest)
+                else:
+                    lower = max(d - entry.radius, 0)
+                    if lower <= kthDistance():
+                        heapq.heappush(pending, (lower, counter, entry.child, d))
+                        counter += 1
+        return sorted([ (recordID, -negDistance) for (negDistance, recordID) in nearest ]
+                     , key=lambda result: result[1])
+
+
+def main():
+    import argparse
+    import common
+
+    parser = argparse.ArgumentParser(description='Complete linkage of Cora with an M-tree.')
+    parser.add_argument( '--threshold'
+                       , type=float
+                       , default=0
+                       , help='Distance threshold for the range queries. Default 0.' )
+    parser.add_argument( '--node-capacity'
+                       , type=int
+                       , default=10
+                       , help='Maximum number of entries in an M-tree node (branching factor). Default 10.' )
+    parser.add_argument( '--comparison-cache'
+                       , type=int
+                       , default=0
+                       , help='Memoize up to this many field comparisons. Default 0, no memoization.' )
+    cmdArgs = parser.parse_args()
+
+    cora_table = common.loadRecordTable("data/cora.csv")
+    cora_lines = [ cora_table.rowList(i, cora_table.fieldNames[2:], missing="")
+                   for i in range(len(cora_table)) ]
+    cora_truth = cora_table.column(cora_table.fieldNames[1])
+    keyFields = range(len(cora_lines[0]))
+    cache = common.ComparisonCache(cmdArgs.comparison_cache) if cmdArgs.comparison_cache > 0 else None
+
+    def distance(a, b):
+        return common.calculateDistance(keyFields, common.levenshtein, common.sigmaMerge, a, b, cache)
+
+    def distanceBatch(query, records):
+        return common.calculateDistancesBatch(keyFields, common.levenshtein, common.sigmaMerge, query, records, cache)
+
+    tree = MTree(distance, cmdArgs.node_capacity, distanceBatch)
+    for (i, line) in enumerate(cora_lines):
+        tree.insert(line)
+        if i % 100 == 0 or i+1 == len(cora_lines):
+            common.tick("M-tree %6.2f%%" % (100 * (i+1) / len(cora_lines)))
+    setupComparisons = tree.nbDistanceCalls
+
+    # every unordered pair once, plus the n self-links, as in scripts/stats.tsv
+    nbLinks = 0
+    nbTruePositives = 0
+    for (i, line) in enumerate(cora_lines):
+        for (j, _) in tree.rangeQuery(line, cmdArgs.threshold):
+            if j < i:
+                continue
+            nbLinks += 1
+            if cora_truth[i] == cora_truth[j]:
+                nbTruePositives += 1
+
+    print("Setup comparisons: %10d" % setupComparisons)
+    print("Total comparisons: %10d" % tree.nbDistanceCalls)
+    print("Number of links  : %10d" % nbLinks)
+    print("True positives   : %10d" % nbTruePositives)
+    if cache != None:
+        print(cache)
+    common.tick("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# a pivot table (LAESA) over records in a metric space
+# the distances between every record and k pivots are computed once, when the table is built
+# a range query only calls the metric for records which the triangle inequality cannot rule out:
+#   d(q,x) >= |d(q,p) - d(x,p)|  for every pivot p
+
+import numpy
+
+
+class PivotTable:
+    """
+    A bulk-loaded pivot table over `records`, using a pluggable `distance(a, b)` metric.
+    Pivots are picked with the max-min-distance heuristic: every new pivot is the record
+    farthest from all pivots picked so far. The record x pivot distance matrix is
+    kept as a NumPy array.
+    Every call to the metric is counted in `nbDistanceCalls`; range queries also count
+    the records pruned by the pivot bounds (`nbPruned`) and the ones evaluated (`nbEvaluated`).
+    The optional `distanceBatch(query, records)` computes the distances from `query` to a
+    list of records in one go (see common.calculateDistancesBatch), it is used to score the candidates.
+    """
+
+    def __init__(self, distance, records, nbPivots=16, firstPivot=0, distanceBatch=None):
+        self.distance = distance
+        self.distanceBatch = distanceBatch
+        self.records = list(records)
+        self.nbDistanceCalls = 0
+        self.nbPruned = 0
+        self.nbEvaluated = 0
+
+        nbRecords = len(self.records)
+        nbPivots = min(nbPivots, nbRecords)
+        self.pivots = []
+        self.pivotDistances = numpy.zeros((nbRecords, nbPivots))
+        minDistances = numpy.full(nbRecords, numpy.inf)
+        pivot = firstPivot
+        for k in range(nbPivots):
+            self.pivots.append(pivot)
+            column = numpy.array([ 0 if i == pivot else self.dist(record, self.records[pivot])
+                                   for (i, record) in enumerate(self.records) ])
+            self.pivotDistances[:, k] = column
+            minDistances = numpy.minimum(minDistances, column)
+            pivot = int(numpy.argmax(minDistances))
+
+    def __len__(self):
+        return len(self.records)
+
+    def dist(self, a, b):
+        self.nbDistanceCalls += 1
+        return self.distance(a, b)
+
+    def distMany(self, query, records):
+        self.nbDistanceCalls += len(records)
+        if self.distanceBatch is None or len(records) == 0:
+            return [ self.distance(query, record) for record in records ]
+        else:
+            return self.distanceBatch(query, records)
+
+    def queryPivotDistances(self, query):
+        return numpy.array([ self.dist(query, self.records[pivot]) for pivot in self.pivots ])
+
+    def rangeQueryPivots(self, query, queryDistances, radius):
+        # lower bound of d(query, x) for every record x, over all pivots
+        lower = numpy.abs(self.pivotDistances - queryDistances[None, :]).max(axis=1)
+        candidates = numpy.flatnonzero(lower <= radius)
+        self.nbPruned += len(self.records) - len(candidates)
+        self.nbEvaluated += len(candidates)
+        distances = self.distMany(query, [ self.records[i] for i in candidates ])
+        return [ (int(i), d) for (i, d) in zip(candidates, distances) if d <= radius ]
+
+    def rangeQuery(self, query, radius):
+        """
+        All records within `radius` of `query`.
+        Returns a list of (recordID, distance) pairs, recordID being the position in `records`.
+        """
+        return self.rangeQueryPivots(query, self.queryPivotDistances(query), radius)
+
+    def rangeQueryById(self, recordID, radius):
+        """
+        Same as `rangeQuery(records[recordID], radius)`, but reuses the stored pivot distances.
+        """
+        return self.rangeQueryPivots(self.records[recordID], self.pivotDistances[recordID], radius)
+
+
+def main():
+    import argparse
+    import common
+
+    parser = argparse.ArgumentParser(description='Complete linkage of Cora with a pivot table.')
+    parser.add_argument( '--threshold'
+                       , type=float
+                       , default=0
+                       , help='Distance threshold for the range queries. Default 0.' )
+    parser.add_argument( '--nb-pivots'
+                       , type=int
+                       , default=16
+                       , help='Number of pivots. Default 16.' )
+    cmdArgs = parser.parse_args()
+
+    cora_table = common.loadRecordTable("data/cora.csv")
+    cora_lines = [ cora_table.rowList(i, cora_table.fieldNames[2:], missing="")
+                   for i in range(len(cora_table)) ]
+    cora_truth = cora_table.column(cora_table.fieldNames[1])
+    keyFields = range(len(cora_lines[0]))
+
+    def distance(a, b):
+        return common.calculateDistance(keyFields, common.levenshtein, common.sigmaMerge, a, b)
+
+    def distanceBatch(query, records):
+        return common.calculateDistancesBatch(keyFields, common.levenshtein, common.sigmaMerge, query, records)
+
+    table = PivotTable(distance, cora_lines, cmdArgs.nb_pivots, distanceBatch=distanceBatch)
+    setupComparisons = table.nbDistanceCalls
+    common.tick("Pivot table, %d pivots" % len(table.pivots))
+
+    # every unordered pair once, plus the n self-links, as in scripts/stats.tsv
+    nbLinks = 0
+    nbTruePositives = 0
+    for i in range(len(cora_lines)):
+        for (j, _) in table.rangeQueryById(i, cmdArgs.threshold):
+            if j < i:
+                continue
+            nbLinks += 1
+            if cora_truth[i] == cora_truth[j]:
+                nbTruePositives += 1
+
+    print("Setup comparisons: %10d" % setupComparisons)
+    print("Total comparisons: %10d" % table.nbDistanceCalls)
+    print("Pruned           : %10d" % table.nbPruned)
+    print("Evaluated        : %10d" % table.nbEvaluated)
+    print("Number of links  : %10d" % nbLinks)
+    print("True positives   : %10d" % nbTruePositives)
+    common.tick("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# traditional, key based blocking over a RecordTable
+# a blocking key is computed from one or more fields of every record, with a key function
+# (prefix, Soundex, year bin, ...) applied to the distinct values of the columns only
+# records with the same key form a block (hash blocking), or records close in key order
+# are paired within a sliding window (sorted neighbourhood); several passes can be combined
+# candidate pairs are streamed as (k, 2) arrays of record IDs (i < j), like LSH.LSHIndex.candidatePairs
+
+import re
+
+import numpy
+
+import LSH
+
+
+################################################################################
+# key functions, String -> String, "" meaning no key
+################################################################################
+
+def normalise(valueStr):
+    return re.sub(r"[^a-z0-9 ]", "", valueStr.lower()).strip()
+
+def exactKey(valueStr):
+    return normalise(valueStr)
+
+def mkPrefixKey(length):
+    def prefixKey(valueStr):
+        return normalise(valueStr).replace(" ", "")[:length]
+    return prefixKey
+
+soundexCodes = { c: str(code) for (letters, code) in [ ("bfpv", 1), ("cgjkqsxz", 2), ("dt", 3)
+                                                     , ("l", 4), ("mn", 5), ("r", 6) ]
+                              for c in letters }
+
+def soundex(valueStr):
+    """
+    The American Soundex code of the first word of `valueStr`, e.g. "Robert" -> "R163".
+    """
+    letters = re.sub(r"[^a-z]", "", (normalise(valueStr).split() or [""])[0])
+    if not letters:
+        return ""
+    code = letters[0].upper()
+    previous = soundexCodes.get(letters[0], "")
+    for c in letters[1:]:
+        digit = soundexCodes.get(c, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w do not separate letters with the same code, vowels do
+        if c not in "hw":
+            previous = digit
+    return code.ljust(4, "0")
+
+def mkYearKey(binWidth=1):
+    def yearKey(valueStr):
+        years = re.findall(r"\b(1[0-9]{3}|20[0-9]{2})\b", valueStr)
+        if not years:
+            return ""
+        year = int(years[0])
+        return "%04d" % (year - year % binWidth)
+    return yearKey
+
+def mkKeyFunction(methodStr):
+    """
+    A key function from its name: "exact", "soundex", "prefixN" (the first N characters)
+    or "yearN" (the year, in bins of N years).
+    """
+    match = re.fullmatch(r"(prefix|year)([0-9]+)", methodStr)
+    if methodStr == "exact":
+        return exactKey
+    elif methodStr == "soundex":
+        return soundex
+    elif match and match.group(1) == "prefix":
+        return mkPrefixKey(int(match.group(2)))
+    elif match and match.group(1) == "year":
+        return mkYearKey(int(match.group(2)))
+    else:
+        raise ValueError("Unknown key function: %s" % methodStr)
+
+
+################################################################################
+# blocking keys of a RecordTable
+################################################################################
+
+def keyCodes(table, fields, keyFunctions):
+    """
+    The blocking key of every record of `table`, from the values of `fields`,
+    the key function keyFunctions[k] being applied to fields[k].
+    Keys are computed once per distinct value of each column, then combined on the codes,
+    so the work per record is a few array operations.
+
+    Returns
+        keys : numpy.ndarray of int64  -- the rank of the record's key in the sorted keys,
+                                          -1 if any of the fields has no key
+    """
+    keys = numpy.zeros(len(table), dtype=numpy.int64)
+    valid = numpy.ones(len(table), dtype=bool)
+    for (field, keyFunction) in zip(fields, keyFunctions):
+        # keyStrs[c] is the key of the dictionary entry c, the rank of "" is 0 as it sorts first
+        keyStrs = [ keyFunction(value) for value in table.dictionaries[field] ] + [ "" ]
+        (uniqueKeys, ranks) = numpy.unique(numpy.array(keyStrs, dtype=str), return_inverse=True)
+        ranks = ranks.reshape(-1)
+        codes = table.codes[field]
+        fieldKeys = ranks[codes]            # code -1 picks the trailing "" entry
+        valid &= (codes >= 0) & (uniqueKeys[fieldKeys] != "")
+        keys = keys * len(uniqueKeys) + fieldKeys
+        if len(fields) > 1:
+            # renumber after every field, so the combined key never overflows
+            keys = numpy.unique(keys, return_inverse=True)[1].reshape(-1)
+    keys[~valid] = -1
+    return keys
+
+
+################################################################################
+# blocking passes
+# each one has
+#   candidatePairs(blockSize)  : yields (k, 2) arrays of record IDs, i < j, each pair once
+#   covers(pairs)              : a boolean mask of the pairs this pass emits
+################################################################################
+
+class HashBlocking:
+    """
+    Blocks of the records with equal `keys` (as computed by keyCodes, -1 for no block).
+    Blocks with more than `maxBlockSize` records are skipped, and counted in
+    `skippedBlocks` and `skippedPairs`.
+    """
+
+    def __init__(self, keys, maxBlockSize=None):
+        self.keys = numpy.asarray(keys)
+        self.maxBlockSize = maxBlockSize
+        # a stable sort groups the records of every block, in increasing record ID order
+        self.order = numpy.argsort(self.keys, kind='stable')
+        self.order = self.order[self.keys[self.order] >= 0]
+        (self.blockKeys, self.offsets) = numpy.unique(self.keys[self.order], return_index=True)
+        self.offsets = numpy.append(self.offsets, len(self.order))
+        self.sizes = numpy.diff(self.offsets)
+        self.usable = numpy.ones(len(self.sizes), dtype=bool)
+        if maxBlockSize is not None:
+            self.usable = self.sizes <= maxBlockSize
+        skipped = self.sizes[~self.usable]
+        self.skippedBlocks = len(skipped)
+        self.skippedPairs = int((skipped * (skipped - 1) // 2).sum())
+
+    def blocks(self):
+        """
+        The record IDs of every usable block with at least 2 records.
+        """
+        for b in numpy.flatnonzero(self.usable & (self.sizes >= 2)):
+            yield self.order[self.offsets[b] : self.offsets[b+1]]
+
+    def candidatePairs(self, blockSize=1<<16):
+        # the same expansion as LSH.LSHIndex.candidatePairs, a block being a bucket
+        for (i, j, _) in LSH.bucketPairs(self.order, self.offsets, self.usable, blockSize):
+            yield numpy.stack((i, j), axis=1)
+
+    def covers(self, pairs):
+        (i, j) = (pairs[:, 0], pairs[:, 1])
+        same = (self.keys[i] == self.keys[j]) & (self.keys[i] >= 0)
+        if self.maxBlockSize is not None:
+            blocks = numpy.searchsorted(self.blockKeys, self.keys[i])
+            same &= self.usable[numpy.minimum(blocks, len(self.usable) - 1)]
+        return same
+
+    def updateStats(self, blockingStats, passID=None):
+        """
+        Put the records of the usable blocks in an evaluation.BlockingStats,
+        with the block keys tagged by `passID` if given, to keep apart the blocks of several passes.
+        The candidate pairs are counted separately, see BlockingStats.addPairs.
+        """
+        keep = self.usable[numpy.searchsorted(self.blockKeys, self.keys[self.order])]
+        blockKeys = self.keys[self.order][keep]
+        if passID is not None:
+            blockKeys = [ (passID, key) for key in blockKeys.tolist() ]
+        # every record is counted once, in the first pass
+        if not passID:
+            blockingStats.addRecords(len(self.keys))
+        blockingStats.add(blockKeys, self.order[keep])
+
+
+class SortedNeighbourhood:
+    """
+    The records are sorted on `keys` (as computed by keyCodes, records without a key are left out),
+    ties broken by record ID, and every record is paired with the next `window` - 1 records.
+    """
+
+    def __init__(self, keys, window):
+        self.keys = numpy.asarray(keys)
+        self.window = window
+        self.order = numpy.argsort(self.keys, kind='stable')
+        self.order = self.order[self.keys[self.order] >= 0]
+        # the position of every record in the sorted order, -1 if it has no key
+        self.positions = numpy.full(len(self.keys), -1, dtype=numpy.int64)
+        self.positions[self.order] = numpy.arange(len(self.order))
+
+    def candidatePairs(self, blockSize=1<<16):
+        perChunk = max(1, blockSize // max(1, self.window - 1))
+        for start in range(0, len(self.order), perChunk):
+            first = numpy.arange(start, min(start + perChunk, len(self.order)))
+            pairs = []
+            for distance in range(1, self.window):
+                p = first[first + distance < len(self.order)]
+                pairs.append(numpy.stack((self.order[p], self.order[p + distance]), axis=1))
+            pairs = numpy.concatenate(pairs) if pairs else numpy.zeros((0, 2), dtype=numpy.int64)
+            if len(pairs) > 0:
+                yield numpy.sort(pairs, axis=1)
+
+    def covers(self, pairs):
+        (pi, pj) = (self.positions[pairs[:, 0]], self.positions[pairs[:, 1]])
+        return (pi >= 0) & (pj >= 0) & (numpy.abs(pi - pj) < self.window)
+
+    def updateStats(self, blockingStats, passID=None):
+        # overlapping windows are not blocks, only the records are counted,
+        # the window pairs are counted from candidatePairs, see BlockingStats.addPairs
+        if not passID:
+            blockingStats.addRecords(len(self.keys))
+
+
+class MultiPassBlocking:
+    """
+    The union of several passes (HashBlocking or SortedNeighbourhood).
+    A pair found by several passes is only emitted by the first one, so every pair is emitted once.
+    """
+
+    def __init__(self, passes):
+        self.passes = list(passes)
+
+    def candidatePairs(self, blockSize=1<<16):
+        for (p, blockingPass) in enumerate(self.passes):
+            for pairs in blockingPass.candidatePairs(blockSize):
+                keep = numpy.ones(len(pairs), dtype=bool)
+                for earlier in self.passes[:p]:
+                    keep &= ~earlier.covers(pairs)
+                if keep.any():
+                    yield pairs[keep]
+
+    def covers(self, pairs):
+        covered = numpy.zeros(len(pairs), dtype=bool)
+        for blockingPass in self.passes:
+            covered |= blockingPass.covers(pairs)
+        return covered
+
+    def updateStats(self, blockingStats):
+        for (p, blockingPass) in enumerate(self.passes):
+            blockingPass.updateStats(blockingStats, p)
+
+
+def mkBlocking(table, passes, window=None, maxBlockSize=None):
+    """
+    A blocking over `table`, from a list of passes, each one a list of (field, key function name),
+    e.g. [[("3", "soundex")], [("10", "year1"), ("5", "prefix4")]].
+    Hash blocking by default, sorted neighbourhood with `window`.
+    """
+    blockings = []
+    for fieldKeys in passes:
+        fields = [ field for (field, _) in fieldKeys ]
+        keys = keyCodes(table, fields, [ mkKeyFunction(methodStr) for (_, methodStr) in fieldKeys ])
+        if window is None:
+            blockings.append(HashBlocking(keys, maxBlockSize))
+        else:
+            blockings.append(SortedNeighbourhood(keys, window))
+    return blockings[0] if len(blockings) == 1 else MultiPassBlocking(blockings)
+
+
+def main():
+    import argparse
+    import common
+    import evaluation
+
+    parser = argparse.ArgumentParser(description='Traditional blocking of Cora.')
+    parser.add_argument( '--pass'
+                       , dest='passes'
+                       , type=str
+                       , nargs='+'
+                       , action='append'
+                       , help='A blocking pass, as field:keyfunction pairs, e.g. --pass 3:soundex --pass 10:year1 5:prefix4. '
+                              'Key functions: exact, soundex, prefixN, yearN. Default one pass on 10:year1.' )
+    parser.add_argument( '--window'
+                       , type=int
+                       , default=None
+                       , help='Sorted neighbourhood window size. Default none, hash blocking.' )
+    parser.add_argument( '--max-block-size'
+                       , type=int
+                       , default=None
+                       , help='Skip hash blocks with more records than this. Default no limit.' )
+    cmdArgs = parser.parse_args()
+    passes = cmdArgs.passes if cmdArgs.passes else [["10:year1"]]
+    passes = [ [ tuple(fieldKey.split(":")) for fieldKey in p ] for p in passes ]
+
+    cora_table = common.loadRecordTable("data/cora.csv")
+    cora_ground_truth = evaluation.GroundTruth.fromColumn(cora_table, cora_table.fieldNames[1])
+    blocking = mkBlocking(cora_table, passes, cmdArgs.window, cmdArgs.max_block_size)
+    common.tick("Blocking, %d passes" % len(passes))
+
+    blockingStats = evaluation.BlockingStats(cora_ground_truth)
+    blocking.updateStats(blockingStats)
+    for pairs in blocking.candidatePairs():
+        blockingStats.addPairs(pairs)
+    print("Candidate pairs  : %10d" % blockingStats.nbCandidatePairs)
+    print("True matches     : %10d of %d" % (blockingStats.nbTruePairs, cora_ground_truth.nbMatches))
+    print(blockingStats)
+    common.tick("Done!")
+
+
+if __name__ == "__main__":
+    main()
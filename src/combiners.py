@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# field combiners: a string comparison method and a weight for every key field
+# a combiner scores a block of candidates against a query in one pass: one compareMany call per field,
+# then a single weighted sum over the (candidates x fields) arrays, as in common.calculateDistancesBatch
+# the weights can be written by hand in a JSON or TSV file, or learnt from labelled pairs by logistic regression
+
+import json
+
+import numpy
+
+import common
+
+
+# the two ways of turning the field values, over the fields which are not missing, into a distance
+#   sum      : bias + sum of weight * (1 - value), the weighted sum of the field distances,
+#              a similarity s in [0, 1] being the distance 1 - s
+#   logistic : 1 - sigmoid(bias + sum of weight * value), one minus the probability that the pair is a match
+links = [ "sum"
+        , "logistic"
+        ]
+
+# the methods whose values are already distances, used as they are by the sum link
+distanceMethods = [ "levenshtein"
+                  ]
+
+
+class FieldCombiner:
+    """
+    The comparison method (any of common.stringComparisonMethods, or "levenshtein" with the native backend)
+    and the weight of each of `fields`, the keys of the fields in the records (list positions, or names
+    as in common.allKeyFields). Missing fields (None, or a failed comparison) are left out of the sum.
+    """
+
+    def __init__(self, fields, methods, weights, bias=0.0, link="sum", backend="febrl"):
+        if link not in links:
+            raise ValueError("Unknown link: %s" % link)
+        self.fields = list(fields)
+        self.methods = list(methods)
+        self.weights = numpy.asarray(weights, dtype=float)
+        self.bias = float(bias)
+        self.link = link
+        self.backend = backend
+        comparison = common.stringComparisonBackends[backend]
+        self.comparisons = [ lambda a, b, methodStr=methodStr: comparison(methodStr, a, b)
+                             for methodStr in self.methods ]
+        self.isDistance = numpy.array([ methodStr in distanceMethods for methodStr in self.methods ], dtype=bool)
+
+    @classmethod
+    def uniform(cls, fields, methodStr="editdist", weight=1.0, backend="febrl"):
+        """
+        The same method and weight for every field, e.g. FieldCombiner.uniform(common.allKeyFields[3]).
+        """
+        fields = list(fields)
+        return cls(fields, [ methodStr ] * len(fields), [ weight ] * len(fields), backend=backend)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def fieldValues(self, query, candidates):
+        """
+        Compare `query` with every record in `candidates`, field by field.
+
+        Returns
+            values  : numpy.ndarray (candidates x fields) of float
+            missing : numpy.ndarray (candidates x fields) of bool
+        """
+        values = numpy.zeros((len(candidates), len(self.fields)))
+        missing = numpy.ones((len(candidates), len(self.fields)), dtype=bool)
+        if len(candidates) > 0:
+            for (k, (f, comparison)) in enumerate(zip(self.fields, self.comparisons)):
+                (values[:, k], missing[:, k]) = common.compareMany(comparison, query[f], [ candidate[f] for candidate in candidates ])
+        return (values, missing)
+
+    def pairFieldValues(self, records, pairs):
+        """
+        fieldValues for a (k, 2) array of record IDs, with one fieldValues call per distinct left-hand record.
+        """
+        values = numpy.zeros((len(pairs), len(self.fields)))
+        missing = numpy.ones((len(pairs), len(self.fields)), dtype=bool)
+        order = numpy.argsort(pairs[:, 0], kind='stable')
+        (lefts, starts) = numpy.unique(pairs[order, 0], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        for (i, start, end) in zip(lefts, starts, ends):
+            rows = order[start:end]
+            (values[rows], missing[rows]) = self.fieldValues(records[i], [ records[j] for j in pairs[rows, 1] ])
+        return (values, missing)
+
+    # a distanceCombiner over these fields, see common.meanMerge
+    def combine(self, values, missing):
+        if self.link == "logistic":
+            total = self.bias + numpy.where(missing, 0, values * self.weights).sum(axis=-1)
+            return 1 - 1 / (1 + numpy.exp(-total))
+        distances = numpy.where(self.isDistance, values, 1 - values)
+        return self.bias + numpy.where(missing, 0, distances * self.weights).sum(axis=-1)
+
+    def distanceBatch(self, query, candidates):
+        """
+        The combined distance from `query` to every record in `candidates`,
+        usable as the `distanceBatch` of verification.verifyPairs, to score and threshold candidate pairs.
+        Neither link gives a metric, so it is not meant for MTree or PivotTable.
+        """
+        return self.combine(*self.fieldValues(query, candidates))
+
+    def distance(self, a, b):
+        return float(self.distanceBatch(a, [ b ])[0])
+
+    def fit(self, values, missing, labels, l2=1e-3, nbIterations=50, tolerance=1e-8):
+        """
+        Learn the weights and the bias by L2 regularised logistic regression, with Newton's method,
+        from the field values of labelled pairs (e.g. from pairFieldValues), labels being True for matches.
+        The link becomes "logistic", so the distance of a pair is one minus its probability of being a match.
+        Returns the number of iterations run.
+        """
+        # the missing fields are 0, as in combine, plus a constant column for the bias
+        features = numpy.hstack(( numpy.ones((len(values), 1)), numpy.where(missing, 0, values) ))
+        labels = numpy.asarray(labels, dtype=float)
+        penalty = numpy.full(features.shape[1], l2 * len(labels))
+        penalty[0] = 0
+        theta = numpy.zeros(features.shape[1])
+        nbIterationsRun = 0
+        for _ in range(nbIterations):
+            nbIterationsRun += 1
+            probabilities = 1 / (1 + numpy.exp(-features @ theta))
+            gradient = features.T @ (probabilities - labels) + penalty * theta
+            hessian = (features * (probabilities * (1 - probabilities))[:, None]).T @ features + numpy.diag(penalty)
+            step = numpy.linalg.solve(hessian + 1e-9 * numpy.eye(len(theta)), gradient)
+            theta -= step
+            if numpy.abs(step).max() < tolerance:
+                break
+        self.bias = float(theta[0])
+        self.weights = theta[1:]
+        self.link = "logistic"
+        return nbIterationsRun
+
+    # configuration files
+    #   JSON : { "link": "sum", "bias": 0, "backend": "febrl",
+    #            "fields": [ { "field": 0, "method": "editdist", "weight": 1.0 }, ... ] }
+    #   TSV  : one line per field: field, method, weight, and optionally lines with 2 columns
+    #          for the settings: link, bias, backend. Fields made of digits are list positions.
+    def toDict(self):
+        return { "link"    : self.link
+               , "bias"    : self.bias
+               , "backend" : self.backend
+               , "fields"  : [ { "field": f, "method": methodStr, "weight": float(weight) }
+                               for (f, methodStr, weight) in zip(self.fields, self.methods, self.weights) ]
+               }
+
+    @classmethod
+    def fromDict(cls, config):
+        fields = config["fields"]
+        return cls( [ field["field"] for field in fields ]
+                  , [ field["method"] for field in fields ]
+                  , [ field.get("weight", 1.0) for field in fields ]
+                  , config.get("bias", 0.0)
+                  , config.get("link", "sum")
+                  , config.get("backend", "febrl")
+                  )
+
+    def save(self, path):
+        with open(path, "w") as f:
+            if path.endswith(".tsv"):
+                for setting in [ "link", "bias", "backend" ]:
+                    f.write("%s\t%s\n" % (setting, getattr(self, setting)))
+                for (field, methodStr, weight) in zip(self.fields, self.methods, self.weights):
+                    f.write("%s\t%s\t%r\n" % (field, methodStr, float(weight)))
+            else:
+                json.dump(self.toDict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            if not path.endswith(".tsv"):
+                return cls.fromDict(json.load(f))
+            config = { "fields": [] }
+            for line in f:
+                columns = line.rstrip("\n").split("\t")
+                if line.strip() == "" or line.startswith("#"):
+                    continue
+                elif len(columns) == 2:
+                    config[columns[0]] = float(columns[1]) if columns[0] == "bias" else columns[1]
+                elif len(columns) == 3:
+                    field = int(columns[0]) if columns[0].isdigit() else columns[0]
+                    config["fields"].append({ "field": field, "method": columns[1], "weight": float(columns[2]) })
+                else:
+                    raise ValueError("Malformed line in %s: %s" % (path, line))
+            return cls.fromDict(config)
+
+    def __str__(self):
+        lines = [ "%-20s %-16s %10.4f" % (f, methodStr, weight)
+                  for (f, methodStr, weight) in zip(self.fields, self.methods, self.weights) ]
+        return "\n".join([ "link %s, bias %.4f" % (self.link, self.bias) ] + lines)
+
+
+def main():
+    import argparse
+    import LSH
+    import evaluation
+
+    parser = argparse.ArgumentParser(description='Learn the field weights of a combiner on Cora.')
+    parser.add_argument( '--config'
+                       , type=str
+                       , default=None
+                       , help='Start from this combiner configuration (JSON, or TSV), for its fields and methods. '
+                              'Default every field with --method.' )
+    parser.add_argument( '--method'
+                       , type=str
+                       , default="editdist"
+                       , help='String comparison method of every field, without --config. Default editdist.' )
+    parser.add_argument( '--backend'
+                       , type=str
+                       , default="febrl"
+                       , choices=sorted(common.stringComparisonBackends.keys())
+                       , help='String comparison backend, without --config. Default febrl.' )
+    parser.add_argument( '--output'
+                       , type=str
+                       , default=None
+                       , help='Save the learnt combiner to this file, as TSV if it ends with .tsv, JSON otherwise.' )
+    cmdArgs = parser.parse_args()
+
+    cora_table = common.loadRecordTable("data/cora.csv")
+    cora_lines = [ cora_table.rowList(i, cora_table.fieldNames[2:]) for i in range(len(cora_table)) ]
+    cora_ground_truth = evaluation.GroundTruth.fromColumn(cora_table, cora_table.fieldNames[1])
+    if cmdArgs.config:
+        combiner = FieldCombiner.load(cmdArgs.config)
+    else:
+        combiner = FieldCombiner.uniform(range(len(cora_lines[0])), cmdArgs.method, backend=cmdArgs.backend)
+    if combiner.backend == "profile":
+        common.profileCache.addRecords(cora_lines, combiner.fields)
+        common.tick("Profiles of %d distinct strings" % len(common.profileCache.profiles))
+
+    # labelled pairs: the LSH candidate pairs, half of them for training and half for testing
+    index = LSH.LSHIndex(2, 5, 3)
+    index.addMany([ [ "" if v is None else v for v in line ] for line in cora_lines ])
+    pairs = numpy.concatenate(list(index.candidatePairs()))
+    labels = cora_ground_truth.isMatch(pairs)
+    (values, missing) = combiner.pairFieldValues(cora_lines, pairs)
+    common.tick("%d labelled pairs, %d matches" % (len(pairs), labels.sum()))
+
+    training = numpy.arange(len(pairs)) % 2 == 0
+    nbIterations = combiner.fit(values[training], missing[training], labels[training])
+    common.tick("Fitted in %d iterations" % nbIterations)
+    print(combiner)
+
+    predictions = combiner.combine(values[~training], missing[~training]) < 0.5
+    truePositives = (predictions & labels[~training]).sum()
+    print("Test pairs : %8d" % (~training).sum())
+    print("Precision  : %8.4f" % (truePositives / max(predictions.sum(), 1)))
+    print("Recall     : %8.4f" % (truePositives / max(labels[~training].sum(), 1)))
+    if cmdArgs.output:
+        combiner.save(cmdArgs.output)
+    common.tick("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
 
 # common functionality here
 
+import collections
 import csv
+import hashlib
 import os
+import re
 import resource
 import socket
 import statistics
 import sys
 import time
 
+import numpy
+
 # febrl
 sys.path.append(os.path.expanduser("~/repos/github/stacs-srg/linkage-py/tools/febrl/febrl-0.4.2"))
 import stringcmp
@@ -39,6 +44,16 @@ def tick(message):
 
 
 
+# sha256 of the contents of a file, as 32 raw bytes
+def fileDigest(filepath):
+    m = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            m.update(chunk)
+    return m.digest()
+
+
+
 class Date:
     day = None
     month = None
@@ -145,6 +160,17 @@ def mkOppositeGender(genderStr):
 
 
 
+# the values of a CSV row, stripped, with None for the missing ones ("n/e" or empty)
+# returns None if all the values are missing, such rows are skipped by loadCSV, iterCSV and parseRecordTable
+def parseRow(row):
+    values = [ col.strip() for col in row ]
+    values = [ None if col == "n/e" or col == "" else col for col in values ]
+    if all(col == None for col in values):
+        return None
+    return values
+
+
+
 def loadCSV(filepath, delimiter=",", verbose=0):
     """
     Load a table from a given CSV/TSV file.
@@ -169,18 +195,10 @@ def loadCSV(filepath, delimiter=",", verbose=0):
             lenValues = len(row)
             if lenFieldNames != lenValues:
                 exit("Mismatch in the number of fields, %d vs %d" % (lenFieldNames, lenValues))
-            row2 = {}
-            allNone = True
-            for i in range(0, lenFieldNames):
-                col = row[i].strip()
-                if col == "n/e" or col == "":
-                    row2[fieldNames[i]] = None
-                else:
-                    row2[fieldNames[i]] = col
-                    allNone = False
+            values = parseRow(row)
             # do not insert into the flatTable if all entries are None
-            if not allNone:
-                rawValues.append(row2)
+            if values != None:
+                rawValues.append(dict(zip(fieldNames, values)))
                 rawValuesArray.append(row)
         if verbose >= 1:
             print("Loaded data from %s, %d fields, %s entries." % (filepath, len(fieldNames), len(rawValues)))
@@ -192,6 +210,237 @@ def loadCSV(filepath, delimiter=",", verbose=0):
 
 
 
+def iterCSV(filepath, delimiter=",", chunkSize=10000, quarantine=None, verbose=0):
+    """
+    Stream a table from a given CSV/TSV file, in chunks of records,
+    parsing and filtering rows in the same way as loadCSV.
+    Only one chunk is held in memory at a time.
+    Rows with the wrong number of fields do not stop the stream: they are skipped,
+    and appended to `quarantine` (a list) as (line number, row) if it is given.
+
+    Input
+        filepath   : String
+        delimiter  : String
+        chunkSize  : Int
+        quarantine : [(Int, [String])]          -- malformed rows are appended here
+        verbose    : Int{0..1}
+
+    Yields
+        values     : [Dict String String]       -- up to chunkSize entries, with fieldNames as the keys
+    """
+    with open(filepath, newline='\n', encoding="latin-1") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        fieldNames = [ x.strip() for x in next(reader) ]
+        lenFieldNames = len(fieldNames)
+        nbRecords = 0
+        nbMalformed = 0
+        chunk = []
+        for row in reader:
+            if lenFieldNames != len(row):
+                nbMalformed += 1
+                if quarantine != None:
+                    quarantine.append((reader.line_num, row))
+                continue
+            values = parseRow(row)
+            # do not yield rows where all entries are None
+            if values != None:
+                chunk.append(dict(zip(fieldNames, values)))
+                nbRecords += 1
+                if len(chunk) >= chunkSize:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+        if verbose >= 1:
+            print("Streamed data from %s, %d fields, %d entries, %d malformed rows." % (filepath, lenFieldNames, nbRecords, nbMalformed))
+
+
+
+class RecordTable:
+    """
+    A columnar table of records, one column per field.
+    Every column stores int32 codes into its own dictionary of distinct values (`dictionaries`),
+    missing values ("n/e" or empty) have code -1 and are also marked in a packed null bitmap (`nullBitmaps`).
+    Rows are only built on demand, by `row` and `rowList`.
+    """
+
+    def __init__(self, fieldNames, dictionaries, codes):
+        self.fieldNames = fieldNames
+        self.dictionaries = dictionaries
+        self.codes = codes
+        self.nullBitmaps = { f: numpy.packbits(codes[f] < 0) for f in fieldNames }
+
+    def __len__(self):
+        return len(self.codes[self.fieldNames[0]]) if self.fieldNames else 0
+
+    def nulls(self, field):
+        return numpy.unpackbits(self.nullBitmaps[field], count=len(self)).astype(bool)
+
+    def value(self, i, field):
+        code = self.codes[field][i]
+        return None if code < 0 else self.dictionaries[field][code]
+
+    def column(self, field):
+        dictionary = self.dictionaries[field]
+        return [ None if code < 0 else dictionary[code] for code in self.codes[field].tolist() ]
+
+    # a row as a dictionary, like the entries of loadCSV's `values`
+    def row(self, i):
+        return { f: self.value(i, f) for f in self.fieldNames }
+
+    # a row as a list, with `missing` in place of missing values
+    def rowList(self, i, fields=None, missing=None):
+        fields = self.fieldNames if fields == None else fields
+        values = [ self.value(i, f) for f in fields ]
+        return [ missing if v == None else v for v in values ]
+
+    def rows(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+
+
+def parseRecordTable(filepath, delimiter=",", fields=None, verbose=0):
+    """
+    Parse a table from a given CSV/TSV file into a RecordTable,
+    parsing and filtering rows in the same way as loadCSV.
+    """
+    with open(filepath, newline='\n', encoding="latin-1") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        fieldNames = [ x.strip() for x in next(reader) ]
+        lenFieldNames = len(fieldNames)
+        if fields == None:
+            fields = fieldNames
+        columns = [ (i, fieldName) for (i, fieldName) in enumerate(fieldNames) if fieldName in fields ]
+        lookups = { fieldName: {} for (_, fieldName) in columns }
+        codes = { fieldName: [] for (_, fieldName) in columns }
+        for row in reader:
+            lenValues = len(row)
+            if lenFieldNames != lenValues:
+                exit("Mismatch in the number of fields, %d vs %d" % (lenFieldNames, lenValues))
+            values = parseRow(row)
+            # do not insert into the table if all entries are None
+            if values == None:
+                continue
+            for (i, fieldName) in columns:
+                col = values[i]
+                if col == None:
+                    codes[fieldName].append(-1)
+                else:
+                    lookup = lookups[fieldName]
+                    codes[fieldName].append(lookup.setdefault(col, len(lookup)))
+    keptFields = [ fieldName for (_, fieldName) in columns ]
+    table = RecordTable( keptFields
+                       , { f: list(lookups[f].keys()) for f in keptFields }
+                       , { f: numpy.array(codes[f], dtype=numpy.int32) for f in keptFields }
+                       )
+    if verbose >= 1:
+        print("Loaded data from %s, %d fields, %s entries." % (filepath, len(keptFields), len(table)))
+    if verbose >= 2:
+        print("Following are the fields.")
+        for fieldName in keptFields:
+            print(" - %s: %d distinct values" % (fieldName, len(table.dictionaries[fieldName])))
+    return table
+
+
+
+# a list of strings as two arrays: their UTF-8 bytes, concatenated, and the offset of every string
+# in them, so that the ith string is blob[offsets[i]:offsets[i+1]], whatever its length or characters
+def encodeStrings(strings):
+    encoded = [ s.encode("utf-8") for s in strings ]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([ len(e) for e in encoded ], dtype=numpy.int64)
+    return (numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8), offsets)
+
+def decodeStrings(blob, offsets):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [ data[start:end].decode("utf-8") for (start, end) in zip(offsets[:-1], offsets[1:]) ]
+
+
+
+# the binary cache of a RecordTable is a .npz file (uncompressed) holding
+#   format        : recordTableCacheFormat, caches in another format are rebuilt
+#   digest        : the sha256 of the source file, as 32 bytes
+#   options       : the delimiter and the selected fields the table was parsed with
+#   fieldNames    : the fields of the table
+#   codes-K       : the codes of the Kth field
+#   dictionary-K  : the dictionary of the Kth field, as encodeStrings bytes
+#   offsets-K     : and offsets
+# strings are stored as UTF-8, not as fixed-width numpy strings, which take 4 bytes per character
+# of the longest string, and drop trailing NUL characters
+recordTableCacheFormat = 2
+
+def saveRecordTableCache(table, cachePath, digest, options):
+    arrays = { "format"     : numpy.array(recordTableCacheFormat)
+             , "digest"     : numpy.frombuffer(digest, dtype=numpy.uint8)
+             , "options"    : numpy.array(options)
+             , "fieldNames" : numpy.array(table.fieldNames, dtype=str)
+             }
+    for (k, f) in enumerate(table.fieldNames):
+        arrays["codes-%d" % k] = table.codes[f]
+        (arrays["dictionary-%d" % k], arrays["offsets-%d" % k]) = encodeStrings(table.dictionaries[f])
+    # write to a temporary file first, so that readers never see a partial cache
+    temporaryPath = "%s.%d.tmp" % (cachePath, os.getpid())
+    with open(temporaryPath, "wb") as f:
+        numpy.savez(f, **arrays)
+    os.replace(temporaryPath, cachePath)
+
+
+
+# returns None if the cache is missing, in another format, or does not match the digest and the options
+def loadRecordTableCache(cachePath, digest, options):
+    if not os.path.isfile(cachePath):
+        return None
+    with numpy.load(cachePath, allow_pickle=False) as arrays:
+        if "format" not in arrays.files or int(arrays["format"]) != recordTableCacheFormat:
+            return None
+        if arrays["digest"].tobytes() != digest or arrays["options"].tolist() != options:
+            return None
+        fieldNames = arrays["fieldNames"].tolist()
+        return RecordTable( fieldNames
+                          , { f: decodeStrings(arrays["dictionary-%d" % k], arrays["offsets-%d" % k]) for (k, f) in enumerate(fieldNames) }
+                          , { f: arrays["codes-%d" % k] for (k, f) in enumerate(fieldNames) }
+                          )
+
+
+
+def loadRecordTable(filepath, delimiter=",", fields=None, verbose=0, cache=True, cachePath=None):
+    """
+    Load a table from a given CSV/TSV file into a RecordTable,
+    parsing and filtering rows in the same way as loadCSV.
+    With `cache`, the parsed table is kept in a binary file next to the source
+    (filepath + ".cache.npz" by default), which is used as long as the contents of
+    the source, the delimiter and the fields are unchanged, and rebuilt otherwise.
+
+    Input
+        filepath   : String
+        delimiter  : String
+        fields     : [String]                   -- fields to keep (e.g. entityFields), default all
+        verbose    : Int{0..2}
+        cache      : Bool
+        cachePath  : String
+
+    Returns
+        table      : RecordTable
+    """
+    if not cache:
+        return parseRecordTable(filepath, delimiter, fields, verbose)
+    if cachePath == None:
+        cachePath = filepath + ".cache.npz"
+    digest = fileDigest(filepath)
+    options = [ delimiter ] + ([] if fields == None else list(fields))
+    table = loadRecordTableCache(cachePath, digest, options)
+    if table != None:
+        if verbose >= 1:
+            print("Loaded data from %s, %d fields, %s entries." % (cachePath, len(table.fieldNames), len(table)))
+        return table
+    table = parseRecordTable(filepath, delimiter, fields, verbose)
+    saveRecordTableCache(table, cachePath, digest, options)
+    return table
+
+
+
 # tablefmt='plain' is the simplest, the default
 # tablefmt='psql' is nice
 # tablefmt='fancy_grid' is also nice, but takes up too much vertical space
@@ -358,23 +607,147 @@ allKeyFields = [ [ "Name", "Surname", "Gender"
 
 
 
-def calculateDistance(keyFields, stringComparison, distanceCombiner, a, b):
-    distances = {}
-    for f in keyFields:
+# memoizes string comparisons, opt-in through the `cache` argument of calculateDistance and friends
+# the results are kept in an LRU of at most `maxSize` entries, keyed on (comparison function, field, string, string),
+# with the strings in ascending order if `symmetric`; the keys only refer to the strings of the records,
+# and nothing else is kept per string, so the memory used is bounded by `maxSize` whatever the number of distinct values
+# the same cache can be shared by all keyFields configurations of a run, since the field names are the same
+class ComparisonCache:
+
+    def __init__(self, maxSize=1000000, symmetric=True):
+        self.maxSize = maxSize
+        self.symmetric = symmetric
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def compare(self, stringComparison, field, aStr, bStr):
+        if self.symmetric and bStr < aStr:
+            key = (stringComparison, field, bStr, aStr)
+        else:
+            key = (stringComparison, field, aStr, bStr)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        distance = stringComparison(aStr, bStr)
+        self.entries[key] = distance
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+        return distance
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return "Comparison cache: %d hits, %d misses (%.2f%% hits), %d entries" \
+            % ( self.hits, self.misses, 100 * self.hits / total if total > 0 else 0, len(self.entries) )
+
+
+
+# the distance between records `a` and `b`, comparing the `keyFields` with `stringComparison`
+# fields where either value is None, or the comparison fails, are missing for the distanceCombiner
+def calculateDistance(keyFields, stringComparison, distanceCombiner, a, b, cache=None):
+    keyFields = list(keyFields)
+    values = numpy.zeros(len(keyFields))
+    missing = numpy.ones(len(keyFields), dtype=bool)
+    for (k, f) in enumerate(keyFields):
         if a[f] == None or b[f] == None:
             pass
         else:
-            distance = stringComparison(a[f],b[f])
+            if cache == None:
+                distance = stringComparison(a[f],b[f])
+            else:
+                distance = cache.compare(stringComparison, f, a[f], b[f])
             if distance != None:
-                distances[f] = distance
+                values[k] = distance
+                missing[k] = False
             # print("%-60s %-30s %-30s %10.2f" % (f,a[f],b[f],distance))
-    combinedDistance = distanceCombiner(distances)
+    combinedDistance = float(distanceCombiner(values, missing))
     # print("%-122s %10.2f" % ("combinedDistance",combinedDistance))
     return combinedDistance
 
 
 
+# calculateDistance, for callers which only need the distance when it is at most `bound` (e.g. range queries)
+# returns the distance if it is at most `bound`, otherwise some value greater than `bound`
+# with a monotone distanceCombiner (see sigmaMerge) the fields are compared in order of decreasing length difference,
+# as a lower bound of their edit distance, then increasing length, and the comparison stops as soon as the fields seen
+# so far exceed `bound`; a string comparison with a `bounded` attribute is passed the remaining budget as maxDistance
+# with any other combiner, this is calculateDistance
+def calculateDistanceBounded(keyFields, stringComparison, distanceCombiner, a, b, bound, cache=None):
+    if not getattr(distanceCombiner, "monotone", False):
+        return calculateDistance(keyFields, stringComparison, distanceCombiner, a, b, cache)
+    keyFields = list(keyFields)
+    order = [ k for (k, f) in enumerate(keyFields) if a[f] != None and b[f] != None ]
+    order.sort(key=lambda k: ( -abs(len(a[keyFields[k]]) - len(b[keyFields[k]]))
+                             , len(a[keyFields[k]]) + len(b[keyFields[k]]) ))
+    bounded = cache == None and getattr(stringComparison, "bounded", False)
+    values = numpy.zeros(len(keyFields))
+    missing = numpy.ones(len(keyFields), dtype=bool)
+    combinedDistance = float(distanceCombiner(values, missing))
+    for k in order:
+        f = keyFields[k]
+        if cache != None:
+            distance = cache.compare(stringComparison, f, a[f], b[f])
+        elif bounded:
+            distance = stringComparison(a[f], b[f], maxDistance=bound - combinedDistance)
+        else:
+            distance = stringComparison(a[f], b[f])
+        if distance != None:
+            values[k] = distance
+            missing[k] = False
+            combinedDistance = float(distanceCombiner(values, missing))
+            if combinedDistance > bound:
+                break
+    return combinedDistance
+
+
+
+# compare one string against many, calling `stringComparison` once per distinct candidate
+# returns a float array of distances, and a boolean array which is True where the query or the candidate is None,
+# or the comparison failed
+# with a ComparisonCache, `field` is the field the strings come from
+def compareMany(stringComparison, queryStr, candidateStrs, cache=None, field=None):
+    values = numpy.zeros(len(candidateStrs))
+    missing = numpy.ones(len(candidateStrs), dtype=bool)
+    if queryStr != None:
+        seen = {}
+        for (k, candidateStr) in enumerate(candidateStrs):
+            if candidateStr == None:
+                continue
+            if candidateStr not in seen:
+                if cache == None:
+                    seen[candidateStr] = stringComparison(queryStr, candidateStr)
+                else:
+                    seen[candidateStr] = cache.compare(stringComparison, field, queryStr, candidateStr)
+            distance = seen[candidateStr]
+            if distance != None:
+                values[k] = distance
+                missing[k] = False
+    return (values, missing)
+
+
+
+# calculateDistance between `query` and every record in `candidates`, one compareMany call per field,
+# and a single distanceCombiner call over the (candidates x keyFields) arrays
+# returns a numpy array of combined distances
+def calculateDistancesBatch(keyFields, stringComparison, distanceCombiner, query, candidates, cache=None):
+    keyFields = list(keyFields)
+    values = numpy.zeros((len(candidates), len(keyFields)))
+    missing = numpy.ones((len(candidates), len(keyFields)), dtype=bool)
+    if len(candidates) > 0:
+        for (k, f) in enumerate(keyFields):
+            (values[:, k], missing[:, k]) = compareMany(stringComparison, query[f], [ candidate[f] for candidate in candidates ], cache, f)
+    return numpy.asarray(distanceCombiner(values, missing), dtype=float)
+
+
+
+# other names of stringComparisonMethods, understood by every backend
+stringComparisonAliases = { "editdistance" : "editdist"
+                          }
+
 def mkStringComparison(methodStr, aStr, bStr):
+    methodStr = stringComparisonAliases.get(methodStr, methodStr)
     aStrCopy = aStr if aStr != None else ""
     bStrCopy = bStr if bStr != None else ""
     if methodStr.startswith('compress'):
@@ -391,22 +764,295 @@ def mkStringComparison(methodStr, aStr, bStr):
         return None
 
 
-# all string comparison methods
+# Levenshtein (edit) distance between two strings: the number of insertions, deletions and substitutions
+# unlike febrl's "editdist" this is not normalised, so it is a metric
+# bit-parallel (Myers 1999, in the formulation of Hyyro 2001), one Python int holds a whole column
+# with `maxDistance`, returns maxDistance+1 as soon as the distance is known to exceed maxDistance
+def levenshtein(aStr, bStr, maxDistance=None):
+    if len(aStr) > len(bStr):
+        aStr, bStr = bStr, aStr
+    m = len(aStr)
+    n = len(bStr)
+    if maxDistance is not None and n - m > maxDistance:
+        return maxDistance + 1
+    if m == 0:
+        return n
+
+    # a bit vector of the positions of each character in the (shorter) pattern
+    peq = {}
+    for (i, c) in enumerate(aStr):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    for (j, c) in enumerate(bStr):
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+        # the score changes by at most one per remaining character
+        if maxDistance is not None and score - (n - j - 1) > maxDistance:
+            return maxDistance + 1
+    return score
+
+# takes maxDistance, see calculateDistanceBounded
+levenshtein.bounded = True
+
+
+
+# a faster backend for some of the methods in stringComparisonMethods, falling back to febrl for the others
+#   "editdist"    : the same normalised similarity as febrl, 1 - distance / length of the longer string
+#   "levenshtein" : the raw distance, honouring maxDistance
+def mkNativeStringComparison(methodStr, aStr, bStr, maxDistance=None):
+    aStrCopy = aStr if aStr != None else ""
+    bStrCopy = bStr if bStr != None else ""
+    if methodStr == "levenshtein":
+        return levenshtein(aStrCopy, bStrCopy, maxDistance)
+    elif stringComparisonAliases.get(methodStr, methodStr) == "editdist":
+        # febrl checks for empty strings first, so two empty strings are 0.0
+        if aStrCopy == "" or bStrCopy == "":
+            return 0.0
+        if aStrCopy == bStrCopy:
+            return 1.0
+        return 1.0 - levenshtein(aStrCopy, bStrCopy) / max(len(aStrCopy), len(bStrCopy))
+    else:
+        return mkStringComparison(methodStr, aStr, bStr)
+
+
+
+# the q-grams of every distinct string, tokenized once and kept as sorted integer arrays,
+# so that the q-gram family of stringComparisonMethods compares arrays instead of slicing strings
+# q-grams are interned into integer IDs, padded q-grams use febrl's start and end characters, chr(1) and chr(2)
+# for every q in 1..3, padded or not, a profile holds
+#   bag       : the sorted keys ID * 2^20 + k of the kth occurrence of every q-gram, so that the size of the
+#               intersection of two bags is the number of q-grams in common, counting repeats as febrl does
+#   positions : the keys ID * 2^20 + position of the q-grams, sorted, and the same in string order
+class ProfileCache:
+
+    profileQs = [ 1, 2, 3 ]
+    positionBits = 20
+
+    def __init__(self):
+        self.qgramIDs = {}
+        self.profiles = {}
+
+    def qgramKeys(self, qgrams):
+        ids = numpy.array([ self.qgramIDs.setdefault(qgram, len(self.qgramIDs)) for qgram in qgrams ], dtype=numpy.int64)
+        return ids << self.positionBits
+
+    def profile(self, valueStr):
+        profile = self.profiles.get(valueStr)
+        if profile != None:
+            return profile
+        profile = { "length": len(valueStr) }
+        for q in self.profileQs:
+            for padded in [ False, True ]:
+                paddedStr = (q-1) * chr(1) + valueStr + (q-1) * chr(2) if padded else valueStr
+                keys = self.qgramKeys([ paddedStr[i:i+q] for i in range(len(paddedStr) - q + 1) ])
+                positional = keys | numpy.arange(len(keys), dtype=numpy.int64)
+                bag = numpy.sort(keys)
+                # the occurrence number of every q-gram among the equal ones
+                starts = numpy.flatnonzero(numpy.diff(bag, prepend=-1))
+                occurrences = numpy.arange(len(bag)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(bag))))
+                profile[(q, padded)] = ( bag | occurrences
+                                       , numpy.sort(positional)
+                                       , positional )
+        self.profiles[valueStr] = profile
+        return profile
+
+    # the profiles of the `keyFields` of every record, computed once, when the data is loaded
+    def addRecords(self, records, keyFields):
+        for record in records:
+            for f in keyFields:
+                if record[f] != None:
+                    self.profile(record[f])
+
+    def qgram(self, aStr, bStr, q, padded, divisor):
+        (a, b) = (self.profile(aStr), self.profile(bStr))
+        (aBag, bBag) = (a[(q, padded)][0], b[(q, padded)][0])
+        if len(aBag) == 0 or len(bBag) == 0:
+            return 0.0
+        common = len(numpy.intersect1d(aBag, bBag, assume_unique=True))
+        return common / divisor(len(aBag), len(bBag))
+
+    def posqgram(self, aStr, bStr, q, padded, divisor, maxDistance=2):
+        (a, b) = (self.profile(aStr), self.profile(bStr))
+        (aPositional, bPositional) = (a[(q, padded)][2], b[(q, padded)][2])
+        if len(aPositional) == 0 or len(bPositional) == 0:
+            return 0.0
+        # as febrl, every q-gram of the shorter string, in order, takes the first unused equal q-gram
+        # of the other one, within maxDistance positions
+        if a["length"] < b["length"]:
+            (shortKeys, longSorted) = (aPositional, b[(q, padded)][1])
+        else:
+            (shortKeys, longSorted) = (bPositional, a[(q, padded)][1])
+        positionMask = (1 << self.positionBits) - 1
+        positions = shortKeys & positionMask
+        lows = numpy.searchsorted(longSorted, (shortKeys - positions) | numpy.maximum(positions - maxDistance, 0))
+        highs = numpy.searchsorted(longSorted, shortKeys + maxDistance, side='right')
+        used = set()
+        common = 0
+        for (low, high) in zip(lows.tolist(), highs.tolist()):
+            for k in range(low, high):
+                if k not in used:
+                    used.add(k)
+                    common += 1
+                    break
+        return common / divisor(len(aPositional), len(bPositional))
+
+    def bagdist(self, aStr, bStr):
+        (a, b) = (self.profile(aStr), self.profile(bStr))
+        common = len(numpy.intersect1d(a[(1, False)][0], b[(1, False)][0], assume_unique=True))
+        longest = max(a["length"], b["length"])
+        return 1.0 - max(a["length"] - common, b["length"] - common) / longest
+
+profileCache = ProfileCache()
+
+profileDivisors = { "short" : min
+                  , "avrg"  : lambda m, n: 0.5 * (m + n)
+                  , "long"  : max
+                  }
+
+
+
+# the q-gram family of stringComparisonMethods from profileCache, falling back to the native backend for the others
+#   "qgram{1,2,3}[P]{short,avrg,long}"    : q-grams in common, divided by the number of q-grams of the shortest,
+#                                           the average or the longest string, P for padded
+#   "posqgram{1,2,3}[P]{short,avrg,long}" : the same, counting q-grams at most 2 positions apart
+#   "bagdist"                             : 1 - the characters of the largest bag difference / the longest length
+# with the same special cases as febrl, in the same order: 0.0 if either string is empty, then 1.0 for equal strings
+def mkProfileStringComparison(methodStr, aStr, bStr, maxDistance=None):
+    aStrCopy = aStr if aStr != None else ""
+    bStrCopy = bStr if bStr != None else ""
+    match = re.fullmatch(r"(qgram|posqgram)([123])(P?)(short|avrg|long)", methodStr)
+    if match == None and methodStr != "bagdist":
+        return mkNativeStringComparison(methodStr, aStr, bStr, maxDistance)
+    if aStrCopy == "" or bStrCopy == "":
+        return 0.0
+    if aStrCopy == bStrCopy:
+        return 1.0
+    if methodStr == "bagdist":
+        return profileCache.bagdist(aStrCopy, bStrCopy)
+    (family, q, padded, divisor) = match.groups()
+    if family == "qgram":
+        return profileCache.qgram(aStrCopy, bStrCopy, int(q), padded == "P", profileDivisors[divisor])
+    else:
+        return profileCache.posqgram(aStrCopy, bStrCopy, int(q), padded == "P", profileDivisors[divisor])
+
+
+
+stringComparisonBackends = { "febrl"   : mkStringComparison
+                           , "native"  : mkNativeStringComparison
+                           , "profile" : mkProfileStringComparison
+                           }
+
+
+
+# the methods a backend offers on top of stringComparisonMethods
+#   "levenshtein" : the raw edit distance (not a similarity), which takes maxDistance, see calculateDistanceBounded
+backendStringComparisonMethods = { "febrl"   : []
+                                 , "native"  : [ "levenshtein" ]
+                                 , "profile" : [ "levenshtein" ]
+                                 }
+
+# the methods whose comparison takes maxDistance
+boundedStringComparisonMethods = [ "levenshtein"
+                                 ]
+
+
+
+# all string comparison methods, using the given backend from stringComparisonBackends
 # each entry is a tuple: first is a description, second is the function (taking two strings and returning a float)
-stringComparisons = [ ( methodStr
-                      # PYTHON'S LAMBDAS SUCK
-                      # https://docs.python.org/3/faq/programming.html#why-do-lambdas-defined-in-a-loop-with-different-values-all-return-the-same-result
-                      , lambda a, b, methodStr=methodStr:
-                            mkStringComparison(methodStr, a, b)
-                      )
-                      for methodStr in stringComparisonMethods
-                    ]
+# the functions of boundedStringComparisonMethods also take maxDistance, and have a `bounded` attribute
+def mkStringComparisons(backend="febrl"):
+    comparison = stringComparisonBackends[backend]
+    comparisons = []
+    for methodStr in stringComparisonMethods + backendStringComparisonMethods[backend]:
+        if methodStr in boundedStringComparisonMethods:
+            # PYTHON'S LAMBDAS SUCK
+            # https://docs.python.org/3/faq/programming.html#why-do-lambdas-defined-in-a-loop-with-different-values-all-return-the-same-result
+            function = lambda a, b, maxDistance=None, methodStr=methodStr: \
+                           comparison(methodStr, a, b, maxDistance)
+            function.bounded = True
+        else:
+            function = lambda a, b, methodStr=methodStr: \
+                           comparison(methodStr, a, b)
+        comparisons.append((methodStr, function))
+    return comparisons
+
+stringComparisons = mkStringComparisons()
+
+
+
+# A distance combiner takes two arrays of the same shape, (fields) for a pair of records or (pairs x fields)
+#   values  : the distance of every field, floats
+#   missing : True where the field was not compared (see calculateDistance), its value is then ignored
+# and returns the combined distance of every pair, combining along the last axis.
+# So a whole block of pairs is combined in one call, see calculateDistancesBatch.
+
+
+
+# This is a distanceCombiner
+# Takes a simple mean of the fields which are not missing, or 0 if they all are
+def meanMerge(values, missing):
+    present = ~missing
+    nbPresent = present.sum(axis=-1)
+    total = numpy.where(present, values, 0).sum(axis=-1)
+    return numpy.where(nbPresent > 0, total / numpy.maximum(nbPresent, 1), 0)
 
 
 
 # This is a distanceCombiner
-# Takes a simple mean, or 0 if the input list is empty
-# "distances" is a dictionary: where the keys are field names, and the values are distances
+# Takes the sum of the fields which are not missing, or 0 if they all are
+# The sum of per-field metrics is a metric, used as "Generic-Sigma-Levenshtein" with `levenshtein`
+def sigmaMerge(values, missing):
+    return numpy.where(missing, 0, values).sum(axis=-1)
+
+
+
+# A distanceCombiner taking the weighted sum of the fields which are not missing,
+# `weights` having one weight per key field, in the same order
+def mkWeightedSumMerge(weights):
+    weights = numpy.asarray(weights, dtype=float)
+
+    def weightedSumMerge(values, missing):
+        return numpy.where(missing, 0, values * weights).sum(axis=-1)
+
+    weightedSumMerge.monotone = bool((weights >= 1).all())
+    return weightedSumMerge
+
+
+
+# a distance combiner is monotone if adding a field with distance x >= 0 raises the combined distance by at least x,
+# so the combined distance of some of the fields is a lower bound of the combined distance of all of them,
+# and calculateDistanceBounded can stop early; a mean is not monotone, adding a small distance lowers it
+meanMerge.monotone = False
+sigmaMerge.monotone = True
+
+
+
+# all distance combiners
+distanceCombiners = [ meanMerge
+                    , sigmaMerge
+                    ]
+
+
+
+# The reference for meanMerge, as distance combiners used to be:
+# takes a dictionary, where the keys are field names and the values are the distances of the fields which
+# are not missing, and returns a simple mean, or 0 if the dictionary is empty
+# it uses exact fractions, which makes it far too slow for scoring pairs, see checkDistanceCombiners
 def simpleMerge(distances):
     if distances == {}:
         return 0
@@ -415,10 +1061,44 @@ def simpleMerge(distances):
 
 
 
-# all distance combiners
-# a distance combiner takes a dictionary as an argument: where the keys are field names, and the values are distances
-# it returns a float representing the combined distance
-distanceCombiners = [ simpleMerge
-                    ]
+# a distanceCombiner calling `dictCombiner` (e.g. simpleMerge) on the dictionary of the fields which are not
+# missing, keyed by their position, once per pair
+def mkDictCombiner(dictCombiner):
+
+    def combiner(values, missing):
+        rows = [ dictCombiner({ k: v for (k, (v, m)) in enumerate(zip(rowValues, rowMissing)) if not m })
+                 for (rowValues, rowMissing) in zip(numpy.reshape(values, (-1, numpy.shape(values)[-1])).tolist()
+                                                   , numpy.reshape(missing, (-1, numpy.shape(missing)[-1])).tolist()) ]
+        return numpy.reshape(numpy.array(rows, dtype=float), numpy.shape(values)[:-1])
+
+    return combiner
+
+
+
+# checks the vectorised distance combiners against a per-pair computation, on `nbPairs` random (pairs x nbFields)
+# arrays with about `missingRate` fields missing, rounding aside: meanMerge against simpleMerge,
+# sigmaMerge and mkWeightedSumMerge against Python sums
+# returns the largest absolute difference found for each combiner, raises an AssertionError above `tolerance`
+#   python3 -c "import common; print(common.checkDistanceCombiners())"
+def checkDistanceCombiners(nbPairs=10000, nbFields=12, missingRate=0.3, seed=0, tolerance=1e-9):
+    rng = numpy.random.default_rng(seed)
+    values = rng.random((nbPairs, nbFields)) * rng.integers(1, 100, (nbPairs, 1))
+    missing = rng.random((nbPairs, nbFields)) < missingRate
+    missing[:10] = True                                 # pairs with no field at all
+    weights = rng.random(nbFields) * 3
+    references = { "meanMerge"          : (meanMerge, mkDictCombiner(simpleMerge))
+                 , "sigmaMerge"         : (sigmaMerge, mkDictCombiner(lambda distances: sum(distances.values())))
+                 , "weightedSumMerge"   : (mkWeightedSumMerge(weights), mkDictCombiner(lambda distances:
+                                              sum(weights[k] * v for (k, v) in distances.items())))
+                 }
+    differences = {}
+    for (name, (combiner, reference)) in references.items():
+        differences[name] = float(numpy.abs(combiner(values, missing) - reference(values, missing)).max())
+        # one pair at a time, as calculateDistance does
+        single = numpy.array([ combiner(values[k], missing[k]) for k in range(min(nbPairs, 100)) ])
+        differences[name] = max(differences[name], float(numpy.abs(single - reference(values[:100], missing[:100])).max()))
+        if differences[name] > tolerance:
+            raise AssertionError("%s differs from the reference by %g" % (name, differences[name]))
+    return differences
 
 
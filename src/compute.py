@@ -1,25 +1,38 @@
 #!/usr/bin/env python3
 
 import common
+import evaluation
 import statistics
 import argparse
+import os
 
 
 def sim_editdistance_mean(l1, l2):
-    similarities = [ common.mkStringComparison("editdistance", a, b)
+    similarities = [ stringComparison("editdistance", a, b)
                      for (a,b) in zip(l1, l2)
                    ]
     mean = statistics.mean(similarities)
     return mean
 
 def sim_editdistance_mean_except_missing(l1, l2):
-    similarities = [ common.mkStringComparison("editdistance", a, b)
+    similarities = [ stringComparison("editdistance", a, b)
                      for (a,b) in zip(l1, l2)
                      if len(a) > 0 and len(b) > 0
                    ]
     mean = statistics.mean(similarities)
     return mean
 
+# sim_editdistance_mean_except_missing between l1 and every line in `candidates`, one comparison call per field
+def sim_editdistance_mean_except_missing_batch(l1, candidates):
+    def noneIfMissing(l):
+        return [ a if len(a) > 0 else None for a in l ]
+    return common.calculateDistancesBatch( range(len(l1))
+                                         , lambda a, b: stringComparison("editdistance", a, b)
+                                         , common.meanMerge
+                                         , noneIfMissing(l1)
+                                         , [ noneIfMissing(l2) for l2 in candidates ]
+                                         )
+
 
 ################################################################################
 # Parsing command line arguments
@@ -42,27 +55,52 @@ parser.add_argument( '--band-size'
                    , type=int
                    , default="3"
                    , help='Band size for LSH. Default 3.' )
+parser.add_argument( '--minhash'
+                   , type=str
+                   , default="md5"
+                   , choices=["md5", "numpy"]
+                   , help='MinHash implementation for LSH: one md5 call per hash and shingle, or the vectorised MinHasher. Default md5.' )
+parser.add_argument( '--max-bucket-size'
+                   , type=int
+                   , default=None
+                   , help='Skip LSH buckets larger than this when generating candidate pairs. Default: no limit.' )
+parser.add_argument( '--workers'
+                   , type=int
+                   , default=1
+                   , help='Number of processes used to build the LSH store and to score the candidate pairs. Default 1.' )
+parser.add_argument( '--index-file'
+                   , type=str
+                   , default=None
+                   , help='Load the LSH store from this file, (re)building and saving it if it is missing or stale.' )
+parser.add_argument( '--backend'
+                   , type=str
+                   , default="febrl"
+                   , choices=sorted(common.stringComparisonBackends.keys())
+                   , help='String comparison backend for the edit distance similarity. Default febrl.' )
 cmdArgs = parser.parse_args()
 print(cmdArgs)
 
+# the string comparison used by the sim_* functions
+stringComparison = common.stringComparisonBackends[cmdArgs.backend]
+
 
 ################################################################################
 # load data
 ################################################################################
 
-(_, _, cora_lines_raw) = common.loadCSV("data/cora.csv")
+# parsed once, then loaded from the binary cache next to the file
+cora_table = common.loadRecordTable("data/cora.csv")
 
 # drop the first column, it is useless
 # drop the second column, it contains the ground truth
-cora_lines = []
-for (i,line) in enumerate(cora_lines_raw):
-    cora_lines.append(line[2:])
+cora_fields = cora_table.fieldNames[2:]
+cora_lines = [ cora_table.rowList(i, cora_fields, missing="")
+               for i in range(len(cora_table)) ]
 
 # if for record numbers i and j,
 # cora_truth[i] == cora_truth[j] implies i and j are true-matches.
-cora_truth = []
-for line in cora_lines_raw:
-    cora_truth.append(line[1])
+cora_truth = cora_table.column(cora_table.fieldNames[1])
+cora_ground_truth = evaluation.GroundTruth(cora_truth)
 
 
 ################################################################################
@@ -70,62 +108,113 @@ for line in cora_lines_raw:
 ################################################################################
 
 import LSH
+import numpy
 
-cora_documentStore = {}
 q = cmdArgs.q
 nbBands = cmdArgs.nb_bands
 bandSize = cmdArgs.band_size
+if cmdArgs.minhash == "numpy":
+    engine = LSH.MinHasher(q, nbBands * bandSize)
+else:
+    engine = LSH.Md5Hasher(q, nbBands * bandSize)
+
+cora_digest = common.fileDigest("data/cora.csv")
+cora_index = None
+blocking_stats = evaluation.BlockingStats(cora_ground_truth)
+if cmdArgs.index_file and os.path.isfile(cmdArgs.index_file):
+    cora_index = LSH.LSHIndex.load(cmdArgs.index_file)
+    if (cora_index.q, cora_index.nbBands, cora_index.bandSize) == (q, nbBands, bandSize) \
+       and type(cora_index.engine) == type(engine) \
+       and cora_index.dataDigest == cora_digest:
+        common.tick("LSH store loaded from %s" % cmdArgs.index_file)
+        # the blocks of a loaded store, from its postings
+        blocking_stats.addRecords(len(cora_index))
+        blocking_stats.add(numpy.repeat(cora_index.bucketKeys, numpy.diff(cora_index.offsets)), cora_index.ids)
+    else:
+        common.tick("LSH store in %s is stale, rebuilding" % cmdArgs.index_file)
+        cora_index = None
 
-for (i, line) in enumerate(cora_lines):
-    LSH.addToStore(q, nbBands, bandSize, cora_documentStore, line)
-    if i % 100 == 0 or i+1 == len(cora_lines):
-        common.tick("LSH store %6.2f%%" % (100 * (i+1) / len(cora_lines)))
-
-mins = []
-maxs = []
-means = []
-block_sizes = []
-
-for (i, line) in enumerate(cora_lines):
-    print("==> %s" % str(line))
-    block = LSH.lookup(q, nbBands, bandSize, cora_documentStore, line)
-    if block:
-        allDistances = [ sim_editdistance_mean_except_missing(line, candidate)
-                         for candidate in block
-                       ]
-        for candidate in block:
-            print("*** %s" % str(candidate))
-        minD = min(allDistances)
-        maxD = max(allDistances)
-        meanD = statistics.mean(allDistances)
+if cora_index is None:
+    if cmdArgs.workers > 1:
+        cora_index = LSH.buildParallel(q, nbBands, bandSize, cora_lines, cmdArgs.workers, engine, blockingStats=blocking_stats)
     else:
-        minD = 0
-        maxD = 0
-        meanD = 0
-        print("*** Empty block")
-
-    mins.append(minD)
-    maxs.append(maxD)
-    means.append(meanD)
-    block_sizes.append(len(block))
-    common.tick("%4d %4d %8.2f %8.2f %8.2f" % (i, len(block), minD, maxD, meanD))
-    print()
-    # input()
-
-print("Min  min  value: %8.2f" % min(mins))
-print("Min  max  value: %8.2f" % min(maxs))
-print("Min  mean value: %8.2f" % min(means))
-print("Min  block size: %8.2f" % min(block_sizes))
+        cora_index = LSH.LSHIndex(q, nbBands, bandSize, engine, blockingStats=blocking_stats)
+        for start in range(0, len(cora_lines), 100):
+            cora_index.addMany(cora_lines[start : start+100])
+            common.tick("LSH store %6.2f%%" % (100 * len(cora_index) / len(cora_lines)))
+            common.tick("    %s" % blocking_stats)
+    cora_index.freeze()
+    if cmdArgs.index_file:
+        cora_index.save(cmdArgs.index_file, cora_digest)
+        common.tick("LSH store saved to %s" % cmdArgs.index_file)
+
+################################################################################
+# verification
+################################################################################
+
+import itertools
+import verification
+
+# each unordered candidate pair once, scored in chunks over a pool of processes,
+# after the pairs (i, i) of the records in the index, as every such record is in its own block
+def progress(nb_chunks, nb_verified):
+    if nb_chunks % 10 == 0:
+        common.tick("Verified %10d pairs" % nb_verified)
+
+# the candidate pairs are counted in blocking_stats on their way to the verification
+def counted(pair_chunks):
+    for pairs in pair_chunks:
+        blocking_stats.addPairs(pairs)
+        yield pairs
+
+(pairs_i, pairs_j, distances) = verification.verifyPairs( cora_lines
+                                                        , sim_editdistance_mean_except_missing_batch
+                                                        , itertools.chain( [ numpy.repeat(numpy.flatnonzero(cora_index.hasSignature), 2).reshape(-1, 2) ]
+                                                                         , counted(cora_index.candidatePairs(cmdArgs.max_bucket_size)) )
+                                                        , cmdArgs.workers
+                                                        , progress=progress
+                                                        )
+common.tick("Verified %10d pairs" % len(distances))
+common.tick("    %s" % blocking_stats)
+
+# the block of record i: every record it is a candidate pair with, in either order
+# record IDs are row numbers, so they index cora_lines and cora_truth directly
+distinct = pairs_i != pairs_j
+records = numpy.concatenate((pairs_i, pairs_j[distinct]))
+record_distances = numpy.concatenate((distances, distances[distinct]))
+order = numpy.argsort(records, kind='stable')
+(blocked, starts) = numpy.unique(records[order], return_index=True)
+block_sizes = numpy.zeros(len(cora_lines), dtype=numpy.int64)
+mins = numpy.zeros(len(cora_lines))
+maxs = numpy.zeros(len(cora_lines))
+means = numpy.zeros(len(cora_lines))
+if len(blocked) > 0:
+    sorted_distances = record_distances[order]
+    block_sizes[blocked] = numpy.diff(numpy.append(starts, len(order)))
+    mins[blocked] = numpy.minimum.reduceat(sorted_distances, starts)
+    maxs[blocked] = numpy.maximum.reduceat(sorted_distances, starts)
+    means[blocked] = numpy.add.reduceat(sorted_distances, starts) / block_sizes[blocked]
+
+print("Min  min  value: %8.2f" % mins.min())
+print("Min  max  value: %8.2f" % maxs.min())
+print("Min  mean value: %8.2f" % means.min())
+print("Min  block size: %8.2f" % block_sizes.min())
+print()
+print("Max  min  value: %8.2f" % mins.max())
+print("Max  max  value: %8.2f" % maxs.max())
+print("Max  mean value: %8.2f" % means.max())
+print("Max  block size: %8.2f" % block_sizes.max())
 print()
-print("Max  min  value: %8.2f" % max(mins))
-print("Max  max  value: %8.2f" % max(maxs))
-print("Max  mean value: %8.2f" % max(means))
-print("Max  block size: %8.2f" % max(block_sizes))
+print("Mean min  value: %8.2f" % mins.mean())
+print("Mean max  value: %8.2f" % maxs.mean())
+print("Mean mean value: %8.2f" % means.mean())
+print("Mean block size: %8.2f" % block_sizes.mean())
 print()
-print("Mean min  value: %8.2f" % statistics.mean(mins))
-print("Mean max  value: %8.2f" % statistics.mean(maxs))
-print("Mean mean value: %8.2f" % statistics.mean(means))
-print("Mean block size: %8.2f" % statistics.mean(block_sizes))
+
+nb_true_pairs = cora_ground_truth.countTruePositives(numpy.stack((pairs_i[distinct], pairs_j[distinct]), axis=1))
+print("Candidate pairs: %8d" % distinct.sum())
+print("True matches   : %8d of %d" % (nb_true_pairs, cora_ground_truth.nbMatches))
+print("Skipped buckets: %8d (%d pairs)" % (cora_index.skippedBuckets, cora_index.skippedPairs))
 print()
 
 
@@ -139,7 +228,7 @@ print()
 #             print(sim_editdistance_mean_except_missing(l1, l2))
 #             print()
 #             input()
-#             # similarities = [ common.mkStringComparison("editdistance", a, b)
+#             # similarities = [ stringComparison("editdistance", a, b)
 #             #                  for (a,b) in zip(l1, l2)
 #             #                ]
 #             # mean = statistics.mean(similarities)
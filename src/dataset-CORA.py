@@ -2,13 +2,23 @@
 
 import common
 import statistics
+import argparse
+
+parser = argparse.ArgumentParser(description='Print the pairs of Cora records with a high mean edit distance similarity.')
+parser.add_argument( '--backend'
+                   , type=str
+                   , default="febrl"
+                   , choices=sorted(common.stringComparisonBackends.keys())
+                   , help='String comparison backend. Default febrl.' )
+cmdArgs = parser.parse_args()
+stringComparison = common.stringComparisonBackends[cmdArgs.backend]
 
 (_, _, cora_lines) = common.loadCSV("data/cora.csv")
 
 for (i,l1) in enumerate(cora_lines):
     for (j,l2) in enumerate(cora_lines):
         if i != j:
-            similarities = [ common.mkStringComparison("editdistance", a, b)
+            similarities = [ stringComparison("editdistance", a, b)
                              for (a,b) in zip(l1, l2)
                            ]
             mean = statistics.mean(similarities)
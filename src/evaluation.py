@@ -0,0 +1,245 @@
+
+# evaluating linkage quality against a ground truth
+
+import collections
+
+import numpy
+
+
+def thresholdSweep(distances, isMatch, thresholds, nbMatches):
+    """
+    Linkage quality at every distance threshold, in one pass over the sorted candidate distances.
+    The links at threshold t are the candidate pairs with distance <= t, so they are a prefix
+    of the pairs sorted by distance; a cumulative count of the true matches along that order
+    gives the true positives at every threshold.
+
+    Input
+        distances  : numpy.ndarray (k,)         -- distance of every candidate pair
+        isMatch    : numpy.ndarray (k,) of bool -- is the candidate pair a true match
+        thresholds : [Float]
+        nbMatches  : Int                        -- number of true matches overall
+
+    Returns
+        results    : Dict String numpy.ndarray  -- "Number of links", "True Positives", "False Positives",
+                                                   "False Negatives", "Precision", "Recall", "F1 Measure",
+                                                   one entry per threshold
+    """
+    order = numpy.argsort(distances, kind='stable')
+    sortedDistances = numpy.asarray(distances)[order]
+    cumulativeMatches = numpy.concatenate(([0], numpy.cumsum(numpy.asarray(isMatch)[order])))
+    links = numpy.searchsorted(sortedDistances, thresholds, side='right')
+    truePositives = cumulativeMatches[links]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        precision = numpy.where(links > 0, truePositives / links, 0.0)
+        recall = truePositives / nbMatches if nbMatches > 0 else numpy.zeros(len(links))
+        f1 = numpy.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return { "Number of links" : links
+           , "True Positives"  : truePositives
+           , "False Positives" : links - truePositives
+           , "False Negatives" : nbMatches - truePositives
+           , "Precision"       : precision
+           , "Recall"          : recall
+           , "F1 Measure"      : f1
+           }
+
+
+class GroundTruth:
+    """
+    The true matches of a data set, as a cluster ID per record: records i and j are a
+    true match iff clusters[i] == clusters[j], i != j.
+    Cluster sizes are precomputed, so the number of true matches is sum C(n, 2) over the clusters,
+    and checking a whole array of candidate pairs is a vectorised comparison of cluster IDs.
+    """
+
+    def __init__(self, labels):
+        """
+        `labels` has one entry per record (e.g. cora_truth), equal labels meaning true matches.
+        A None label is a record known to match no other record.
+        """
+        known = numpy.array([ label is not None for label in labels ], dtype=bool)
+        self.clusters = numpy.zeros(len(labels), dtype=numpy.int64)
+        nbClusters = 0
+        if known.any():
+            (_, codes) = numpy.unique([ str(label) for label in labels if label is not None ], return_inverse=True)
+            self.clusters[known] = codes
+            nbClusters = int(codes.max()) + 1
+        # every unlabelled record is a cluster of its own
+        self.clusters[~known] = nbClusters + numpy.arange((~known).sum())
+        self.clusterSizes = numpy.bincount(self.clusters)
+        self.nbMatches = int((self.clusterSizes * (self.clusterSizes - 1) // 2).sum())
+
+    def __len__(self):
+        return len(self.clusters)
+
+    @classmethod
+    def fromColumn(cls, table, field):
+        """
+        From a label column of a common.RecordTable, e.g. field "2" of data/cora.csv.
+        """
+        return cls(table.column(field))
+
+    @classmethod
+    def fromLinks(cls, ids, links, separator=None):
+        """
+        From a column of record identifiers (e.g. "ID") and a column of links (e.g. "KnownLinks"),
+        each link entry listing the identifiers of other records, split on `separator`
+        (whitespace by default). Linked records are matches, transitively.
+        """
+        position = { recordID: i for (i, recordID) in enumerate(ids) }
+        parent = list(range(len(ids)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for (i, link) in enumerate(links):
+            if link is None:
+                continue
+            for other in link.split(separator):
+                j = position.get(other.strip())
+                if j is not None:
+                    parent[find(i)] = find(j)
+        return cls([ find(i) for i in range(len(ids)) ])
+
+    def isMatch(self, pairs):
+        """
+        A bool per row of a (k, 2) array of record IDs.
+        """
+        pairs = numpy.asarray(pairs).reshape(-1, 2)
+        return (self.clusters[pairs[:, 0]] == self.clusters[pairs[:, 1]]) & (pairs[:, 0] != pairs[:, 1])
+
+    def countTruePositives(self, pairs):
+        return int(self.isMatch(pairs).sum())
+
+    def pairsCompleteness(self, pairs):
+        """
+        The fraction of all true matches found among the candidate `pairs` (distinct, unordered).
+        """
+        return self.countTruePositives(pairs) / self.nbMatches if self.nbMatches > 0 else 0
+
+    def pairsQuality(self, pairs):
+        """
+        The fraction of the candidate `pairs` (distinct, unordered) which are true matches.
+        """
+        return self.countTruePositives(pairs) / len(pairs) if len(pairs) > 0 else 0
+
+
+class BlockingStats:
+    """
+    Blocking quality counters.
+    Per block, updated while records are put into blocks by an index (`add`): adding a record
+    to a block holding s records adds s pairs to the block; with a GroundTruth, it also adds
+    c true pairs, c being the number of records of its cluster already in the block.
+    Overall, from the distinct candidate pairs (`addPairs`), e.g. from LSH.LSHIndex.candidatePairs,
+    which emits a pair sharing several blocks only once, from the first one:
+    the reduction ratio, pairs completeness and pairs quality. These are not kept up to date
+    while the index is built, they need a pass over the candidate pairs.
+    """
+
+    def __init__(self, groundTruth=None):
+        self.groundTruth = groundTruth
+        self.nbRecords = 0
+        self.nbCandidatePairs = 0
+        self.nbTruePairs = 0
+        self.pairsCounted = False
+        self.blockSizes = {}
+        self.blockTruePairs = collections.Counter()
+        self.blockClusterCounts = collections.Counter()
+
+    def addRecords(self, nbRecords):
+        """
+        Count records inserted, whether they are put into blocks or not.
+        """
+        self.nbRecords += nbRecords
+
+    def add(self, blockKeys, recordIDs):
+        """
+        Put records in blocks: one (block key, record ID) entry per row, block keys being
+        any hashable values. All the entries of a record are expected in the same call.
+        """
+        recordIDs = numpy.asarray(recordIDs, dtype=numpy.int64)
+        if self.groundTruth is None:
+            clusters = [ None ] * len(recordIDs)
+        else:
+            clusters = self.groundTruth.clusters[recordIDs].tolist()
+        if isinstance(blockKeys, numpy.ndarray):
+            blockKeys = blockKeys.tolist()
+        for (key, cluster) in zip(blockKeys, clusters):
+            size = self.blockSizes.get(key, 0)
+            self.blockSizes[key] = size + 1
+            if cluster is not None:
+                count = self.blockClusterCounts[(key, cluster)]
+                self.blockTruePairs[key] += count
+                self.blockClusterCounts[(key, cluster)] = count + 1
+
+    def addPairs(self, pairs):
+        """
+        Count candidate pairs, a (k, 2) array of record IDs, each pair given once overall.
+        """
+        self.pairsCounted = True
+        self.nbCandidatePairs += len(pairs)
+        if self.groundTruth is not None:
+            self.nbTruePairs += self.groundTruth.countTruePositives(pairs)
+
+    def reductionRatio(self):
+        allPairs = self.nbRecords * (self.nbRecords - 1) // 2
+        return 1 - self.nbCandidatePairs / allPairs if allPairs > 0 else 0
+
+    def pairsCompleteness(self):
+        nbMatches = self.groundTruth.nbMatches
+        return self.nbTruePairs / nbMatches if nbMatches > 0 else 0
+
+    def pairsQuality(self):
+        return self.nbTruePairs / self.nbCandidatePairs if self.nbCandidatePairs > 0 else 0
+
+    def blockQualities(self):
+        """
+        Per-block pairs quality and pairs completeness, for the blocks with at least 2 records:
+        the fraction of the pairs in the block which are true matches, and the fraction of the
+        true matches among the block's clusters which the block contains.
+        """
+        matchesPerBlock = collections.Counter()
+        for ((key, cluster), count) in self.blockClusterCounts.items():
+            size = self.groundTruth.clusterSizes[cluster]
+            matchesPerBlock[key] += size * (size - 1) // 2
+        quality = []
+        completeness = []
+        for (key, size) in self.blockSizes.items():
+            if size < 2:
+                continue
+            quality.append(self.blockTruePairs[key] / (size * (size - 1) // 2))
+            if matchesPerBlock[key] > 0:
+                completeness.append(self.blockTruePairs[key] / matchesPerBlock[key])
+        return (numpy.array(quality), numpy.array(completeness))
+
+    def __str__(self):
+        text = "%d records, %d blocks" % (self.nbRecords, len(self.blockSizes))
+        if self.pairsCounted:
+            text += ", %d candidate pairs, reduction ratio %.4f" % (self.nbCandidatePairs, self.reductionRatio())
+            if self.groundTruth is not None:
+                text += ", pairs completeness %.4f, pairs quality %.4f" % (self.pairsCompleteness(), self.pairsQuality())
+        return text
+
+
+def evaluateLinkage(pairs, distances, truth, thresholds, selfPairs=False):
+    """
+    thresholdSweep for candidate `pairs` (a (k, 2) array of record IDs) with the given `distances`,
+    against `truth`: a GroundTruth, or a list of labels as accepted by GroundTruth (e.g. cora_truth).
+    Also returns the number of true matches overall, as "Number of matches".
+    With `selfPairs`, every record is also linked to itself at distance 0, and these n links
+    count as true positives and as matches, as in scripts/stats.tsv.
+    """
+    if not isinstance(truth, GroundTruth):
+        truth = GroundTruth(truth)
+    isMatch = truth.isMatch(pairs)
+    nbMatches = truth.nbMatches
+    if selfPairs:
+        nbRecords = len(truth.clusters)
+        distances = numpy.concatenate((numpy.zeros(nbRecords), distances))
+        isMatch = numpy.concatenate((numpy.ones(nbRecords, dtype=bool), isMatch))
+        nbMatches += nbRecords
+    results = thresholdSweep(distances, isMatch, thresholds, nbMatches)
+    results["Number of matches"] = numpy.full(len(thresholds), nbMatches)
+    return results
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# cheap lower bounds of the Generic-Sigma-Levenshtein distance
+# (common.calculateDistance with common.levenshtein and common.sigmaMerge), used to discard candidate pairs
+# before the exact comparison; for every field compared (both values not None),
+#   length    : levenshtein(a, b) >= | len(a) - len(b) |
+#   q-gram    : levenshtein(a, b) >= L1(qgrams(a), qgrams(b)) / 2q, as one edit changes at most q q-grams
+#               into at most q others
+#   histogram : levenshtein(a, b) >= L1(characters(a), characters(b)) / 2, the same with q = 1
+# and the bound of a pair is the sum over its fields. q-grams and characters are counted in a fixed
+# number of bins, hashing several into one bin only lowers the L1 distance, so the bounds stay valid
+
+import numpy
+
+import LSH
+
+
+class LowerBoundFilters:
+    """
+    The signatures of every field of every record, computed once, as NumPy arrays:
+        lengths    : (records x fields) int32, -1 where the value is None
+        qgrams     : (records x fields x nbBins) int16, the counts of the q-grams (LSH.computeShingles) per bin
+        histograms : (records x fields x nbBins) int16, the counts of the characters per bin
+    That is 4 * nbBins + 4 bytes per field and record.
+    `filterPairs` runs the cascade length, q-gram, histogram over blocks of pairs, and counts
+    the pairs each filter removed in `nbRemoved`, and the pairs it was given in `nbPairs`.
+    """
+
+    filterNames = [ "length", "qgram", "histogram" ]
+
+    def __init__(self, records, keyFields=None, q=2, nbBins=32):
+        records = list(records)
+        if keyFields is None:
+            keyFields = range(len(records[0])) if records else []
+        keyFields = list(keyFields)
+        self.q = q
+        self.nbBins = nbBins
+        self.lengths = numpy.full((len(records), len(keyFields)), -1, dtype=numpy.int32)
+        self.qgrams = numpy.zeros((len(records), len(keyFields), nbBins), dtype=numpy.int16)
+        self.histograms = numpy.zeros((len(records), len(keyFields), nbBins), dtype=numpy.int16)
+        self.nbPairs = 0
+        self.nbRemoved = { name: 0 for name in self.filterNames }
+
+        # the signatures of every distinct value, computed once
+        signatures = {}
+        for (i, record) in enumerate(records):
+            for (k, f) in enumerate(keyFields):
+                value = record[f]
+                if value is None:
+                    continue
+                if value not in signatures:
+                    shingleBins = [ LSH.shingleHash(shingle) % nbBins for shingle in LSH.computeShingles(q, value) ]
+                    characterBins = [ ord(c) % nbBins for c in value ]
+                    signatures[value] = ( numpy.bincount(shingleBins, minlength=nbBins)
+                                        , numpy.bincount(characterBins, minlength=nbBins) )
+                self.lengths[i, k] = len(value)
+                (self.qgrams[i, k], self.histograms[i, k]) = signatures[value]
+
+    def lowerBounds(self, pairs, filterName):
+        """
+        The lower bound of the distance of every pair in a (k, 2) array of record IDs,
+        from a single filter.
+        """
+        (i, j) = (pairs[:, 0], pairs[:, 1])
+        compared = (self.lengths[i] >= 0) & (self.lengths[j] >= 0)
+        if filterName == "length":
+            bounds = numpy.abs(self.lengths[i] - self.lengths[j])
+        elif filterName == "qgram":
+            l1 = numpy.abs(self.qgrams[i].astype(numpy.int32) - self.qgrams[j]).sum(axis=2)
+            bounds = -(-l1 // (2 * self.q))
+        elif filterName == "histogram":
+            l1 = numpy.abs(self.histograms[i].astype(numpy.int32) - self.histograms[j]).sum(axis=2)
+            bounds = -(-l1 // 2)
+        else:
+            raise ValueError("Unknown filter: %s" % filterName)
+        return numpy.where(compared, bounds, 0)
+
+    def filterPairs(self, pairs, bound, chunkSize=1<<14):
+        """
+        The pairs of a (k, 2) array of record IDs whose distance may be at most `bound`.
+        Every filter only looks at the pairs the previous ones kept, and the bound of a field
+        is the best one found so far. The pairs go through the cascade `chunkSize` at a time,
+        so the (pairs x fields x nbBins) arrays of the q-gram and histogram filters stay small.
+        """
+        pairs = numpy.asarray(pairs).reshape(-1, 2)
+        self.nbPairs += len(pairs)
+        kept = [ pairs[0:0] ]
+        for start in range(0, len(pairs), chunkSize):
+            chunk = pairs[start : start+chunkSize]
+            fieldBounds = numpy.zeros((len(chunk), self.lengths.shape[1]), dtype=numpy.int64)
+            for filterName in self.filterNames:
+                if len(chunk) == 0:
+                    break
+                fieldBounds = numpy.maximum(fieldBounds, self.lowerBounds(chunk, filterName))
+                keep = fieldBounds.sum(axis=1) <= bound
+                self.nbRemoved[filterName] += int((~keep).sum())
+                chunk = chunk[keep]
+                fieldBounds = fieldBounds[keep]
+            kept.append(chunk)
+        return numpy.concatenate(kept)
+
+    def __str__(self):
+        return "Lower bound filters: %d pairs, %s removed, %d left" \
+            % ( self.nbPairs
+              , ", ".join("%d by %s" % (self.nbRemoved[name], name) for name in self.filterNames)
+              , self.nbPairs - sum(self.nbRemoved.values()) )
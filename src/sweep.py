@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# a parameter sweep producing rows in the format of scripts/stats.tsv
+# for every index configuration, the candidate pairs and their distances are computed once,
+# and all distance thresholds are evaluated from that single list of distances
+# configurations run in parallel, in a pool of processes
+
+import argparse
+import concurrent.futures
+import itertools
+import os
+import resource
+import sys
+import time
+
+import numpy
+
+import common
+import evaluation
+import verification
+
+
+statsColumns = [ "Data Set (Source)"
+               , "Data Set (Sink)"
+               , "Linker"
+               , "Distance Method"
+               , "Distance Threshold"
+               , "Time taken"
+               , "Memory used"
+               , "Setup comparisons"
+               , "Total comparisons"
+               , "Number of links"
+               , "Number of matches"
+               , "True Positives"
+               , "False Positives"
+               , "False Negatives"
+               , "Min links quality"
+               , "Max links quality"
+               , "Average links quality"
+               , "Min pairs quality"
+               , "Max pairs quality"
+               , "Average pairs quality"
+               , "Min pairs completeness"
+               , "Max pairs completeness"
+               , "Average pairs completeness"
+               , "Precision"
+               , "Recall"
+               , "F1 Measure"
+               , "Shingle size"
+               , "Number of bands"
+               , "Band size"
+               , "Blocking Method"
+               , "Branching factor"
+               ]
+
+linkerNames = { "BruteForce"   : "Brute Force"
+              , "LSH"          : "LSH"
+              , "MTree"        : "MTree"
+              , "TradBlocking" : "TradBlocking"
+              }
+
+
+################################################################################
+# data
+################################################################################
+
+def loadCora():
+    """
+    Returns
+        table : common.RecordTable
+        lines : [[String]]              -- the records, missing values as ""
+        truth : evaluation.GroundTruth  -- from the second column
+    """
+    table = common.loadRecordTable("data/cora.csv")
+    lines = [ table.rowList(i, table.fieldNames[2:], missing="")
+              for i in range(len(table)) ]
+    truth = evaluation.GroundTruth.fromColumn(table, table.fieldNames[1])
+    return (table, lines, truth)
+
+# the blocking key function of the fields of Cora: 3 authors, 5 title, 7 venue, 8 location, 9 publisher, 10 year
+# the "all" blocking method is the union of one pass per field
+coraBlockingKeys = { "3"  : "soundex"
+                   , "5"  : "prefix4"
+                   , "7"  : "prefix4"
+                   , "8"  : "prefix4"
+                   , "9"  : "prefix4"
+                   , "10" : "year1"
+                   }
+
+datasets = { "CORA" : ("Cora", "Generic-Sigma-Levenshtein", loadCora, coraBlockingKeys)
+           }
+
+# with a `bound`, distanceBatch only computes the distances up to `bound`, the others are some value above it
+def mkDistances(lines, bound=None):
+    keyFields = range(len(lines[0]))
+
+    def distance(a, b):
+        return common.calculateDistance(keyFields, common.levenshtein, common.sigmaMerge, a, b)
+
+    def distanceBatch(query, records):
+        if bound is None:
+            return common.calculateDistancesBatch(keyFields, common.levenshtein, common.sigmaMerge, query, records)
+        return [ common.calculateDistanceBounded(keyFields, common.levenshtein, common.sigmaMerge, query, record, bound)
+                 for record in records ]
+
+    return (distance, distanceBatch)
+
+def verifyCandidates(lines, pairs, config, maxThreshold):
+    """
+    The candidate pairs which may be within maxThreshold, after the lower bound filters
+    unless they are disabled in `config`, and their distances.
+    """
+    (_, distanceBatch) = mkDistances(lines, maxThreshold)
+    if config["filters"]:
+        import filters
+        lowerBoundFilters = filters.LowerBoundFilters(lines)
+        pairs = lowerBoundFilters.filterPairs(pairs, maxThreshold)
+        common.tick("%s" % lowerBoundFilters)
+    (_, _, distances) = verification.verifyPairs(lines, distanceBatch, verification.splitPairs(pairs), config["verifyWorkers"])
+    return (pairs, distances)
+
+
+################################################################################
+# linkers
+# each returns (pairs, distances, setup comparisons, total comparisons, blocking stats)
+# pairs (i, j) with i < j, and distances, for every pair that may be linked at maxThreshold
+# total comparisons counts the candidate pairs, including the ones the lower bound filters discard,
+# and all the n^2 ordered pairs for brute force, as in scripts/stats.tsv
+# blocking stats is an evaluation.BlockingStats for linkers which block, None otherwise
+################################################################################
+
+def linkBruteForce(table, lines, truth, config, maxThreshold):
+    (i, j) = numpy.triu_indices(len(lines), 1)
+    (pairs, distances) = verifyCandidates(lines, numpy.stack((i, j), axis=1), config, maxThreshold)
+    return (pairs, distances, 0, len(lines) ** 2, None)
+
+def linkLSH(table, lines, truth, config, maxThreshold):
+    import LSH
+    blockingStats = evaluation.BlockingStats(truth)
+    index = LSH.LSHIndex(config["q"], config["nbBands"], config["bandSize"], blockingStats=blockingStats)
+    index.addMany(lines)
+    blocks = list(index.candidatePairs())
+    pairs = numpy.concatenate(blocks) if blocks else numpy.zeros((0, 2), dtype=numpy.int32)
+    blockingStats.addPairs(pairs)
+    (pairs, distances) = verifyCandidates(lines, pairs, config, maxThreshold)
+    return (pairs, distances, 0, blockingStats.nbCandidatePairs, blockingStats)
+
+def linkMTree(table, lines, truth, config, maxThreshold):
+    import MTree
+    (distance, distanceBatch) = mkDistances(lines)
+    tree = MTree.MTree(distance, config["branchingFactor"], distanceBatch)
+    tree.insertMany(lines)
+    setupComparisons = tree.nbDistanceCalls
+    pairs = []
+    distances = []
+    # a single range query per record at the largest threshold covers all the smaller ones
+    for (i, line) in enumerate(lines):
+        for (j, d) in tree.rangeQuery(line, maxThreshold):
+            if i < j:
+                pairs.append((i, j))
+                distances.append(d)
+    pairs = numpy.array(pairs, dtype=numpy.int64).reshape(-1, 2)
+    return (pairs, numpy.array(distances, dtype=float), setupComparisons, tree.nbDistanceCalls, None)
+
+def linkTradBlocking(table, lines, truth, config, maxThreshold):
+    import blocking
+    blockingKeys = datasets[config["dataset"]][3]
+    if config["blockingMethod"] == "all":
+        passes = [ [(field, methodStr)] for (field, methodStr) in sorted(blockingKeys.items()) ]
+    else:
+        passes = [ [(config["blockingMethod"], blockingKeys[config["blockingMethod"]])] ]
+    blocker = blocking.mkBlocking(table, passes)
+    blockingStats = evaluation.BlockingStats(truth)
+    blocker.updateStats(blockingStats)
+    blocks = list(blocker.candidatePairs())
+    pairs = numpy.concatenate(blocks) if blocks else numpy.zeros((0, 2), dtype=numpy.int64)
+    blockingStats.addPairs(pairs)
+    (pairs, distances) = verifyCandidates(lines, pairs, config, maxThreshold)
+    return (pairs, distances, 0, blockingStats.nbCandidatePairs, blockingStats)
+
+linkers = { "BruteForce"   : linkBruteForce
+          , "LSH"          : linkLSH
+          , "MTree"        : linkMTree
+          , "TradBlocking" : linkTradBlocking
+          }
+
+
+################################################################################
+# running configurations
+################################################################################
+
+def runConfiguration(config):
+    """
+    Run one index configuration over all thresholds, in a worker process.
+    Returns the stats.tsv rows, as lists of strings.
+    """
+    (datasetName, distanceMethod, load, _) = datasets[config["dataset"]]
+    (table, lines, truth) = load()
+    thresholds = config["thresholds"]
+
+    start = time.time()
+    (pairs, distances, setupComparisons, totalComparisons, blockingStats) = \
+        linkers[config["linker"]](table, lines, truth, config, max(thresholds))
+    timeTaken = int(1000 * (time.time() - start))
+    # peak resident memory of this worker, in bytes (ru_maxrss is in kilobytes on Linux, bytes on macOS)
+    # every configuration runs in a new worker, see main
+    memoryUsed = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    # the n self-pairs are links, true positives and matches in scripts/stats.tsv
+    results = evaluation.evaluateLinkage(pairs, distances, truth, thresholds, selfPairs=True)
+    # per-block pairs quality and completeness, the same at every threshold
+    blockColumns = {}
+    if blockingStats is not None:
+        for (measure, values) in zip(["pairs quality", "pairs completeness"], blockingStats.blockQualities()):
+            if len(values) > 0:
+                blockColumns.update({ "Min %s" % measure     : "%.2f" % values.min()
+                                    , "Max %s" % measure     : "%.2f" % values.max()
+                                    , "Average %s" % measure : "%.2f" % values.mean()
+                                    })
+
+    rows = []
+    for (k, threshold) in enumerate(thresholds):
+        row = { column: "NA" for column in statsColumns }
+        for counter in ["Number of links", "Number of matches", "True Positives", "False Positives", "False Negatives"]:
+            row[counter] = int(results[counter][k])
+        for measure in ["Precision", "Recall", "F1 Measure"]:
+            row[measure] = "%.2f" % results[measure][k]
+        row.update(blockColumns)
+        row.update({ "Data Set (Source)" : datasetName
+                   , "Data Set (Sink)"   : datasetName
+                   , "Linker"            : linkerNames[config["linker"]]
+                   , "Distance Method"   : distanceMethod
+                   , "Distance Threshold": "%.2f" % threshold
+                   , "Time taken"        : timeTaken
+                   , "Memory used"       : memoryUsed
+                   , "Setup comparisons" : setupComparisons
+                   , "Total comparisons" : totalComparisons
+                   , "Shingle size"      : config.get("q", "NA")
+                   , "Number of bands"   : config.get("nbBands", "NA")
+                   , "Band size"         : config.get("bandSize", "NA")
+                   , "Blocking Method"   : config.get("blockingMethod", "NA")
+                   , "Branching factor"  : config.get("branchingFactor", "NA")
+                   })
+        rows.append([ str(row[column]) for column in statsColumns ])
+    return rows
+
+def mkConfigurations(cmdArgs, thresholds):
+    configs = []
+    for linker in cmdArgs.linkers:
+        base = { "dataset": cmdArgs.dataset, "linker": linker, "thresholds": thresholds, "verifyWorkers": cmdArgs.verify_workers
+               , "filters": cmdArgs.filters }
+        if linker == "LSH":
+            for (q, nbBands, bandSize) in itertools.product(cmdArgs.shingle_sizes, cmdArgs.nb_bands, cmdArgs.band_sizes):
+                configs.append(dict(base, q=q, nbBands=nbBands, bandSize=bandSize))
+        elif linker == "MTree":
+            for branchingFactor in cmdArgs.branching_factors:
+                configs.append(dict(base, branchingFactor=branchingFactor))
+        elif linker == "TradBlocking":
+            for blockingMethod in cmdArgs.blocking_methods:
+                configs.append(dict(base, blockingMethod=blockingMethod))
+        else:
+            configs.append(base)
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a grid of linkage configurations, writing stats.tsv rows.')
+    parser.add_argument( '--dataset'
+                       , type=str
+                       , default="CORA"
+                       , choices=sorted(datasets.keys())
+                       , help='Which data set to use. Possible values: CORA.' )
+    parser.add_argument( '--linkers'
+                       , type=str
+                       , nargs='+'
+                       , default=["LSH"]
+                       , choices=sorted(linkers.keys())
+                       , help='Linkers to run. Default LSH.' )
+    parser.add_argument( '--max-threshold'
+                       , type=float
+                       , default=250
+                       , help='Largest distance threshold. Default 250.' )
+    parser.add_argument( '--threshold-step'
+                       , type=float
+                       , default=1
+                       , help='Step between distance thresholds, starting from 0. Default 1.' )
+    parser.add_argument( '--shingle-sizes'
+                       , type=int
+                       , nargs='+'
+                       , default=[2]
+                       , help='Shingle widths for LSH. Default 2.' )
+    parser.add_argument( '--nb-bands'
+                       , type=int
+                       , nargs='+'
+                       , default=[2, 5, 10]
+                       , help='Numbers of bands for LSH. Default 2 5 10.' )
+    parser.add_argument( '--band-sizes'
+                       , type=int
+                       , nargs='+'
+                       , default=[2, 5, 10]
+                       , help='Band sizes for LSH. Default 2 5 10.' )
+    parser.add_argument( '--branching-factors'
+                       , type=int
+                       , nargs='+'
+                       , default=[10]
+                       , help='Node capacities for the M-tree. Default 10.' )
+    parser.add_argument( '--blocking-methods'
+                       , type=str
+                       , nargs='+'
+                       , default=[ "3", "5", "7", "8", "9", "10", "all" ]
+                       , help='Fields to block on for TradBlocking, or "all" for the union of one pass per field. '
+                              'Default 3 5 7 8 9 10 all.' )
+    parser.add_argument( '--workers'
+                       , type=int
+                       , default=os.cpu_count()
+                       , help='Number of configurations run in parallel. Default: the number of CPUs.' )
+    parser.add_argument( '--verify-workers'
+                       , type=int
+                       , default=1
+                       , help='Number of processes scoring the candidate pairs of each configuration. Default 1.' )
+    parser.add_argument( '--no-filters'
+                       , dest='filters'
+                       , action='store_false'
+                       , help='Compute the distance of every candidate pair, without the lower bound filters in front.' )
+    parser.add_argument( '--output'
+                       , type=str
+                       , default="stats.tsv"
+                       , help='The rows are appended to this file, with a header if it is new. Default stats.tsv.' )
+    cmdArgs = parser.parse_args()
+    print(cmdArgs)
+
+    thresholds = list(numpy.arange(0, cmdArgs.max_threshold + cmdArgs.threshold_step / 2, cmdArgs.threshold_step))
+    configs = mkConfigurations(cmdArgs, thresholds)
+
+    newFile = not os.path.isfile(cmdArgs.output) or os.path.getsize(cmdArgs.output) == 0
+    with open(cmdArgs.output, "a") as output:
+        if newFile:
+            output.write("\t".join(statsColumns) + "\n")
+        # a fresh process for every configuration, so that its peak memory is its own
+        with concurrent.futures.ProcessPoolExecutor(max_workers=cmdArgs.workers, max_tasks_per_child=1) as executor:
+            futures = [ executor.submit(runConfiguration, config) for config in configs ]
+            for (config, future) in zip(configs, futures):
+                rows = future.result()
+                for row in rows:
+                    output.write("\t".join(row) + "\n")
+                output.flush()
+                common.tick("%-10s %s" % ( config["linker"]
+                                         , " ".join("%s=%s" % (k, v) for (k, v) in sorted(config.items())
+                                                    if k not in ("dataset", "linker", "thresholds", "verifyWorkers", "filters")) ))
+    common.tick("Done!")
+
+
+if __name__ == "__main__":
+    main()
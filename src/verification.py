@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# the verification stage of a linkage: scoring candidate pairs
+# chunks of candidate pairs, as produced by LSH.LSHIndex.candidatePairs or blocking, are scored
+# over a pool of processes; the records and the distance function are shared with the workers
+# by forking after they are set in module globals, so a task only carries its pairs, never records
+
+import concurrent.futures
+import multiprocessing
+import os
+
+import numpy
+
+
+# set by verifyPairs before the pool is created, inherited by the forked workers
+sharedRecords = None
+sharedDistanceBatch = None
+
+
+def pairDistances(records, pairs, distanceBatch):
+    """
+    The distance of every pair in a (k, 2) array of record IDs,
+    computed with one distanceBatch(query, records) call per distinct left-hand record.
+    """
+    distances = numpy.zeros(len(pairs))
+    order = numpy.argsort(pairs[:, 0], kind='stable')
+    (lefts, starts) = numpy.unique(pairs[order, 0], return_index=True)
+    ends = numpy.append(starts[1:], len(order))
+    for (i, start, end) in zip(lefts, starts, ends):
+        rows = order[start:end]
+        distances[rows] = distanceBatch(records[i], [ records[j] for j in pairs[rows, 1] ])
+    return distances
+
+def verifyChunk(pairs):
+    return pairDistances(sharedRecords, pairs, sharedDistanceBatch)
+
+def splitPairs(pairs, chunkSize=1<<14):
+    """
+    A (k, 2) array of pairs as a list of chunks of at most `chunkSize` pairs, for verifyPairs.
+    """
+    return [ pairs[x : x+chunkSize] for x in range(0, len(pairs), chunkSize) ]
+
+
+def verifyPairs(records, distanceBatch, pairChunks, nbWorkers=None, maxPending=None, progress=None):
+    """
+    Score candidate pairs in parallel.
+
+    Input
+        records       : [a]                              -- indexed by record ID
+        distanceBatch : (a, [a]) -> [Float]              -- e.g. common.calculateDistancesBatch with fixed key fields
+        pairChunks    : iterable of numpy.ndarray (k, 2) -- record ID pairs, e.g. LSHIndex.candidatePairs()
+        nbWorkers     : Int                              -- processes, default the number of CPUs, 1 for no pool
+        maxPending    : Int                              -- chunks in flight, default 4 per worker
+        progress      : (Int, Int) -> ()                 -- called with (chunks, pairs) verified so far
+
+    Returns
+        i, j          : numpy.ndarray of int64           -- the pairs, in the order of the chunks
+        distances     : numpy.ndarray of float
+    """
+    global sharedRecords, sharedDistanceBatch
+
+    if nbWorkers is None:
+        nbWorkers = os.cpu_count()
+    if maxPending is None:
+        maxPending = 4 * nbWorkers
+    results = []
+    nbPairs = 0
+
+    def collect(result):
+        nonlocal nbPairs
+        results.append(result)
+        nbPairs += len(result[0])
+        if progress is not None:
+            progress(len(results), nbPairs)
+
+    # forking is what shares the records, without it (e.g. on Windows) pairs are scored in this process
+    if nbWorkers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for pairs in pairChunks:
+            pairs = numpy.asarray(pairs)
+            collect((pairs, pairDistances(records, pairs, distanceBatch)))
+    else:
+        sharedRecords = records
+        sharedDistanceBatch = distanceBatch
+        try:
+            context = multiprocessing.get_context("fork")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=nbWorkers, mp_context=context) as executor:
+                # a bounded window of chunks in flight, collected in submission order
+                pending = []
+                for pairs in pairChunks:
+                    pairs = numpy.asarray(pairs)
+                    pending.append((pairs, executor.submit(verifyChunk, pairs)))
+                    if len(pending) >= maxPending:
+                        (pairs, future) = pending.pop(0)
+                        collect((pairs, future.result()))
+                for (pairs, future) in pending:
+                    collect((pairs, future.result()))
+        finally:
+            sharedRecords = None
+            sharedDistanceBatch = None
+
+    if not results:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+    pairs = numpy.concatenate([ pairs.reshape(-1, 2) for (pairs, _) in results ]).astype(numpy.int64)
+    distances = numpy.concatenate([ distances for (_, distances) in results ])
+    return (pairs[:, 0], pairs[:, 1], distances)